@@ -0,0 +1,275 @@
+#!/usr/bin/python2
+
+'''
+Benchmarks of sarc.py on synthetic archives.
+
+Generates directory trees with a mix of tiny and large files and BFLIM files
+that need alignment, then times creating, opening (read or memory mapped),
+listing, looking up, extracting and round tripping their archives in both byte
+orders. Every operation runs in its own process, so its peak memory is
+measured alone, and the results are checked after they are measured.
+Results are saved as JSON, and compared with a previous run to catch
+regressions.
+'''
+
+import os, sys, argparse, json, time, random, shutil, tempfile, subprocess, platform, resource
+from struct import pack
+
+import sarc
+
+OPERATIONS = ['create', 'open_read', 'open_mmap', 'list', 'lookup', 'extract', 'roundtrip']
+DEFAULT_COUNTS = [100, 1000, sarc.Sarc.FATBlockHeader._C_ARCHIVE_ENTRY_MAX]
+LOOKUP_COUNT = 1000
+BFLIM_ALIGNMENTS = [0x80, 0x200, 0x1000]
+
+def generate_tree(path, count, order, seed=0):
+    """Generate a directory of files to archive.
+
+    Most files are tiny, some are BFLIM textures with an alignment footer and
+    a few are large. The same arguments always generate the same files.
+
+    Args:
+        path: Path to the directory to create.
+        count: Number of files.
+        order: Byte order of the BFLIM footers. Must be '>' or '<'.
+        seed: Random seed.
+
+    Returns:
+        Total size of the files.
+    """
+    rand = random.Random(seed)
+    total = 0
+    for i in range(count):
+        kind = rand.random()
+        if kind < 0.2:
+            name = 'timg/%02d/img_%05d.bflim'%(i % 16, i)
+            data = make_bflim(rand, rand.randint(0x100, 0x8000), order,
+                              rand.choice(BFLIM_ALIGNMENTS))
+        elif kind < 0.21:
+            name = 'misc/large_%05d.bin'%i
+            data = random_bytes(rand, rand.randint(0x100000, 0x400000))
+        else:
+            name = 'blyt/%02d/layout_%05d.bflyt'%(i % 32, i)
+            data = random_bytes(rand, rand.randint(0, 0x200))
+        full_path = os.path.join(path, name)
+        sarc.mkdirs(os.path.dirname(full_path))
+        sarc.write_file(full_path, data)
+        total += len(data)
+    return total
+
+
+def make_bflim(rand, size, order, alignment):
+    """Make the data of a BFLIM file with its footer."""
+    footer = ('FLIM' + pack(order + 'HHIIHH', 0xfeff, 0x14, 0x2020000, size, 1, 0) +
+              'imag' + pack(order + 'IHHHBBI', 0x10, 8, 8, alignment, 0, 0, size - 0x28))
+    return random_bytes(rand, size - len(footer)) + footer
+
+
+def random_bytes(rand, size):
+    # Compressible enough to look like assets, fast to generate.
+    block = ''.join(chr(rand.randint(0, 255)) for _ in range(min(size, 0x400)))
+    return (block * (size // max(len(block), 1) + 1))[:size]
+
+
+def tree_size(path):
+    return sum(os.path.getsize(p) for p in sarc.walk(path))
+
+
+def run_operation(op, work, order, names):
+    """Run a single operation and return its measurements.
+
+    The time and the peak memory are taken before the results are checked, so
+    the checks aren't measured.
+    """
+    tree = os.path.join(work, 'tree')
+    archive = os.path.join(work, 'archive.sarc')
+    out = os.path.join(work, 'out')
+    rebuilt = archive + '.rt'
+    ret = {}
+    start = time.time()
+    if op == 'create':
+        s = sarc.Sarc(path=tree, order=order)
+        s.archive(archive)
+    elif op in ('open_read', 'open_mmap'):
+        s = sarc.Sarc(path=archive, use_mmap=op == 'open_mmap')
+        s.close()
+    elif op == 'list':
+        s = sarc.Sarc(path=archive, use_mmap=True)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            s.extract(path='', all=True, save_file=False)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        s.close()
+        ret['items'] = len(s.entries)
+    elif op == 'lookup':
+        s = sarc.Sarc(path=archive, use_mmap=True)
+        start = time.time()
+        for name in names:
+            if s.find(name) is None:
+                raise KeyError(name)
+        s.close()
+        ret['items'] = len(names)
+    elif op == 'extract':
+        s = sarc.Sarc(path=archive, use_mmap=True)
+        s.extract(path=out, all=True)
+        s.close()
+    elif op == 'roundtrip':
+        # Extract and create the archive again, the result must be identical.
+        s = sarc.Sarc(path=archive, use_mmap=True)
+        s.extract(path=out + '_rt', all=True)
+        s.close()
+        sarc.Sarc(path=out + '_rt', order=order).archive(rebuilt)
+    ret['seconds'] = time.time() - start
+    ret['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if op in ('create', 'open_read', 'open_mmap'):
+        ret['bytes'] = os.path.getsize(archive)
+    elif op == 'extract':
+        ret['bytes'] = tree_size(out)
+    elif op == 'roundtrip':
+        ret['bytes'] = os.path.getsize(rebuilt)
+        ret['identical'] = sarc.file_digest(rebuilt) == sarc.file_digest(archive)
+    return ret
+
+
+def measure(op, work, order, names, repeat):
+    """Run an operation 'repeat' times in fresh processes, keeping the fastest run."""
+    best = None
+    for _ in range(repeat):
+        if op in ('extract', 'roundtrip'):
+            for d in ('out', 'out_rt'):
+                shutil.rmtree(os.path.join(work, d), ignore_errors=True)
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', op,
+                                 '--work', work, '--order', order],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = proc.communicate(json.dumps(names))[0]
+        if proc.returncode:
+            raise RuntimeError('%s failed'%op)
+        result = json.loads(output.splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    if best['seconds'] > 0:
+        if 'bytes' in best:
+            best['mb_per_s'] = best['bytes'] / best['seconds'] / 0x100000
+        if 'items' in best:
+            best['per_s'] = best['items'] / best['seconds']
+    return best
+
+
+def run_benchmarks(counts, orders, operations, repeat=1, seed=0, work_dir=None, verbose=True):
+    """Run the benchmarks.
+
+    Args:
+        counts: Numbers of files per archive.
+        orders: Byte orders, '<' and/or '>'.
+        operations: Names of the operations from 'OPERATIONS'.
+        repeat: Runs per operation, the fastest is kept.
+        seed: Random seed of the generated files.
+        work_dir: Directory for the generated files. Default a temporary directory.
+        verbose: Print every result.
+
+    Returns:
+        Dict of the environment and the list of results.
+    """
+    root = work_dir or tempfile.mkdtemp(prefix='sarc_bench_')
+    results = []
+    try:
+        for count in counts:
+            for order in orders:
+                work = os.path.join(root, '%d_%s'%(count, 'le' if order == '<' else 'be'))
+                shutil.rmtree(work, ignore_errors=True)
+                tree = os.path.join(work, 'tree')
+                total = generate_tree(tree, count, order, seed)
+                names = [sarc.getrpath(tree, p) for p in sarc.walk(tree)]
+                names = random.Random(seed).sample(names, min(LOOKUP_COUNT, len(names)))
+                if 'create' not in operations:
+                    sarc.Sarc(path=tree, order=order).archive(os.path.join(work, 'archive.sarc'))
+                for op in operations:
+                    result = measure(op, work, order, names, repeat)
+                    result.update({'operation': op, 'count': count, 'order': order,
+                                   'input_bytes': total})
+                    results.append(result)
+                    if verbose:
+                        print format_result(result)
+                shutil.rmtree(work, ignore_errors=True)
+    finally:
+        if not work_dir:
+            shutil.rmtree(root, ignore_errors=True)
+    return {'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': sarc.numpy is not None,
+            'seed': seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def format_result(result):
+    line = '%-10s %6d %s %9.4fs %8d KB'%(result['operation'], result['count'], result['order'],
+                                         result['seconds'], result['peak_rss_kb'])
+    if 'mb_per_s' in result:
+        line += ' %9.1f MB/s'%result['mb_per_s']
+    if 'per_s' in result:
+        line += ' %9.0f /s'%result['per_s']
+    if result.get('identical') is False:
+        line += ' NOT IDENTICAL'
+    return line
+
+
+def compare(old, new, threshold=0.1):
+    """Print the change of every result from a previous run.
+
+    Args:
+        old: Results of the previous run.
+        new: Results of this run.
+        threshold: Relative slowdown reported as a regression.
+
+    Returns:
+        Number of regressions.
+    """
+    key = lambda r: (r['operation'], r['count'], r['order'])
+    previous = {key(r):r for r in old['results']}
+    regressions = 0
+    for r in new['results']:
+        p = previous.get(key(r))
+        if not p or not p['seconds']:
+            continue
+        change = r['seconds'] / p['seconds'] - 1
+        regressed = change > threshold
+        regressions += regressed
+        print '%-10s %6d %s %9.4fs -> %9.4fs %+7.1f%%%s'%(key(r) + (p['seconds'], r['seconds'],
+                                                        change * 100, ' REGRESSION' if regressed else ''))
+    return regressions
+
+
+if '__main__' == __name__:
+    endianess = {'big':'>', 'little':'<'}
+    parser = argparse.ArgumentParser(description='Benchmark sarc.py on synthetic archives')
+    parser.add_argument('-n', '--counts', help='Set numbers of files per archive', nargs='+', type=int, default=DEFAULT_COUNTS)
+    parser.add_argument('-e', '--endianess', help='Set archive endianess', nargs='+', choices=['big', 'little'], default=['little', 'big'])
+    parser.add_argument('-p', '--operations', help='Set operations to time', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('-r', '--repeat', help='Set runs per operation, the fastest is kept', type=int, default=3)
+    parser.add_argument('-s', '--seed', help='Set random seed of the generated files', type=int, default=0)
+    parser.add_argument('-o', '--output', help='Save results to a JSON file')
+    parser.add_argument('-c', '--compare', help='Compare with results saved by a previous run')
+    parser.add_argument('-t', '--threshold', help='Set relative slowdown reported as a regression', type=float, default=0.1)
+    parser.add_argument('-d', '--dir', help='Set working directory, default a temporary directory')
+    parser.add_argument('--run', help=argparse.SUPPRESS, choices=OPERATIONS)
+    parser.add_argument('--work', help=argparse.SUPPRESS)
+    parser.add_argument('--order', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        names = [n.encode('utf-8') for n in json.loads(sys.stdin.read())]
+        print json.dumps(run_operation(args.run, args.work, args.order, names))
+        sys.exit(0)
+
+    report = run_benchmarks(args.counts, [endianess[e] for e in args.endianess],
+                            args.operations, args.repeat, args.seed, args.dir)
+    if args.output:
+        fs = open(args.output, 'w')
+        json.dump(report, fs, indent=1, sort_keys=True)
+        fs.close()
+    if args.compare:
+        sys.exit(1 if compare(json.load(open(args.compare, 'r')), report, args.threshold) else 0)
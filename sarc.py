@@ -24,10 +24,37 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-import os, argparse, fnmatch
-from struct import pack, unpack, calcsize
+import os, sys, io, argparse, fnmatch, mmap, array, bisect, json, hashlib, cStringIO, errno, ctypes
+import threading, collections, sqlite3, glob, time, multiprocessing, tarfile, tempfile
+from multiprocessing.pool import ThreadPool
+from struct import pack, unpack, calcsize, error as StructError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 DEFAULT_HASH_KEY = 0x65
+COPY_CHUNK_SIZE = 0x100000
+UPDATE_HEADROOM = 0x1000
+READ_AHEAD_SIZE = 0x2000000
+READ_AHEAD_FILE_SIZE = 0x400000
+UINT32_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+NUMPY_HASH_THRESHOLD = 1024
+UNNAMED_FORMAT = '%08X.bin'
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_VERSION = 1
+CATALOG_PATTERNS = ['*.sarc', '*.szs']
+DIFF_PARALLEL_SIZE = 0x10000
+YAZ0_SIGNATURE = 'Yaz0'
+YAZ0_HEADER_SIZE = 0x10
+YAZ0_DEFAULT_LEVEL = 3
+# (Hash chain depth, match length to stop searching at) for levels 0 to 9
+YAZ0_LEVELS = [(0, 0), (1, 4), (2, 8), (4, 16), (8, 32),
+               (16, 64), (32, 128), (64, 256), (128, 0x111), (256, 0x111)]
+_YAZ0_WINDOW = 0x1000
+_YAZ0_MIN_MATCH = 3
+_YAZ0_MAX_MATCH = 0x111
 
 class Sarc(object):
     """SHArchive class
@@ -40,63 +67,182 @@ class Sarc(object):
         entries: File entries
         fnt_data: Binary File Name Table (FNT) data
         archive_data: Archive file data
+        name_map: Dict of hash to file name for entries stored without a name
+        jobs: Number of threads reading files when creating an archive
     """
 
 
-    def __init__(self, path='', order='', hash_key=DEFAULT_HASH_KEY, exclude=[]):
+    def __init__(self, path='', order='', hash_key=DEFAULT_HASH_KEY, exclude=[], use_mmap=False, jobs=1,
+                 data=None, stats=None):
         """Initialize Sarc class.
 
         Args:
             path: Path to an archive file when initializing with an archive for extraction or adding files,
-                  or path to a directory when initializing with a directory for creation.
+                  or path to a directory when initializing with a directory for creation. Leave it
+                  empty and set 'order' to create an empty archive to add files to.
             order: Required only if you are creating an archive. Must be '>' or '<'.
             hash_key: Required only if you are creating an archive. Default 0x65 (101).
+            use_mmap: Map the archive file into memory instead of reading it. Only the headers are
+                      decoded when opening, FAT entries are decoded on demand. Yaz0 compressed
+                      archives are always decompressed into memory.
+            jobs: Number of threads reading file metadata when initializing with a directory,
+                  and reading file contents ahead of writing them when archiving.
+            data: Archive data, a str, buffer or mmap object, to initialize with instead of
+                  a path. The data is referenced, not copied, unless it is Yaz0 compressed.
+            stats: Stats instance recording the time spent in each phase. Can also be set
+                   later through the 'stats' attribute.
 
         Returns:
             None
+        
+        Raises:
+            ValueError: When the archive is not a valid SARC or Yaz0 compressed SARC,
+                        or is truncated.
         """
-        self.exclude = exclude
-        if os.path.isfile(path):
-            (self.header, self.fatheader, self.entries, 
-             self.fnt_data, self.archive_data) = self._read_archive(path)
+        self.exclude = exclude or []
+        self._file = None
+        self._mmap = None
+        self._names = None
+        self._path = None
+        self._yaz0 = False
+        self._sources = []
+        self.name_map = {}
+        self.stats = stats
+        self.jobs = jobs
+        if stats:
+            start = time.time()
+        if data is not None:
+            self._open_data(data)
+        elif os.path.isfile(path):
+            self._open_archive(path, use_mmap)
         elif os.path.isdir(path):
             self._base_path = path
-            self._create_archive(order, hash_key)
+            self._create_archive(order, hash_key, jobs)
+            return
+        elif order:
+            self._base_path = ''
+            self._new_archive(order, hash_key)
+            return
+        if stats and (data is not None or os.path.isfile(path)):
+            stats.add('open', time.time() - start, len(self.archive_data) + len(self.fnt_data))
     
     
-    def _create_archive(self, order, hash_key):
+    def _new_archive(self, order, hash_key):
         self.header = Sarc.ArchiveBlockHeader(order=order)
         self.fatheader = Sarc.FATBlockHeader(order=order, hash_key=hash_key)
         self.entries = None
-        file_list = walk(self._base_path)
-        for f in file_list:
-            self._add_file_entry(f)
         self.fnt_data = ''
         self.archive_data = ''
     
     
+    def _create_archive(self, order, hash_key, jobs=1):
+        self._new_archive(order, hash_key)
+        if self.stats:
+            start = time.time()
+        paths = walk(self._base_path)
+        if self.stats:
+            self.stats.add('walk', time.time() - start, count=len(paths))
+        self.add_file_entries(paths, jobs)
+    
+    
+    def _open_archive(self, path, use_mmap):
+        self._path = path
+        self._names = None
+        self._yaz0 = is_yaz0(path)
+        if self._yaz0:
+            (self.header, self.fatheader, self.entries,
+             self.fnt_data, self.archive_data) = self._decompress_archive(path)
+        elif use_mmap:
+            (self.header, self.fatheader, self.entries,
+             self.fnt_data, self.archive_data) = self._map_archive(path)
+        else:
+            (self.header, self.fatheader, self.entries,
+             self.fnt_data, self.archive_data) = self._read_archive(path)
+    
+    
+    def _open_data(self, data):
+        self._yaz0 = data[:len(YAZ0_SIGNATURE)] == YAZ0_SIGNATURE
+        if self._yaz0:
+            out = cStringIO.StringIO()
+            yaz0_decompress(cStringIO.StringIO(data), out)
+            data = out.getvalue()
+        (self.header, self.fatheader, self.entries,
+         self.fnt_data, self.archive_data) = self._parse_archive(data)
+    
+    
     def _read_archive(self, path):
+        return self._parse_archive(open(path,'rb').read())
+    
+    
+    def _decompress_archive(self, path):
+        fs = open(path, 'rb')
+        data = cStringIO.StringIO()
+        yaz0_decompress(fs, data)
+        fs.close()
+        return self._parse_archive(data.getvalue())
+    
+    
+    def _map_archive(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._parse_archive(self._mmap)
+    
+    
+    def _parse_archive(self, data):
+        if data[:4] != Sarc.ArchiveBlockHeader.C_SIGNATURE:
+            raise ValueError('Invalid SARC signature')
+        try:
+            return self._parse_blocks(data)
+        except StructError:
+            raise ValueError('Truncated SARC data')
+    
+    
+    def _parse_blocks(self, data):
         cur_pos = 0
-        data = open(path,'rb').read()
         header = Sarc.ArchiveBlockHeader(data[cur_pos:cur_pos + Sarc.ArchiveBlockHeader.C_STRUCTURE_SIZE])
         cur_pos += header.header_size
         fatheader = Sarc.FATBlockHeader(data=data[cur_pos:cur_pos + Sarc.FATBlockHeader.C_STRUCTURE_SIZE],
                                         order=header.order)
         cur_pos += fatheader.header_size
-        fatentries = []
-        for i in range(fatheader.file_count):
-            fatentries.append(Sarc.FATEntry(data=data[cur_pos:cur_pos + Sarc.FATEntry.C_STRUCTURE_SIZE],
-                                            order=header.order))
-            cur_pos += Sarc.FATEntry.C_STRUCTURE_SIZE
-        entries = {e.hash:e for e in fatentries}
+        if (cur_pos + fatheader.file_count * Sarc.FATEntry.C_STRUCTURE_SIZE > len(data) or
+            header.data_block_offset > len(data)):
+            raise StructError('FAT or data block beyond the end of the data')
+        entries = Sarc.FATTable(data, cur_pos, fatheader.file_count, header.order)
+        cur_pos += fatheader.file_count * Sarc.FATEntry.C_STRUCTURE_SIZE
         fntheader = Sarc.FNTBlockHeader(data=data[cur_pos:cur_pos+Sarc.FNTBlockHeader.C_STRUCTURE_SIZE],
                                         order=header.order)
         cur_pos += fntheader.header_size
-        fnt_data = data[cur_pos:header.data_block_offset]
-        archive_data = data[header.data_block_offset:]
+        fnt_data = view(data, cur_pos, header.data_block_offset)
+        archive_data = view(data, header.data_block_offset)
         return header, fatheader, entries, fnt_data, archive_data
     
     
+    def close(self):
+        """Release the memory map and the archive file opened with 'use_mmap', and
+        the files read by 'add_tar'.
+
+        Returns:
+            None
+        """
+        for source in self._sources:
+            source.close()
+        self._sources = []
+        if self._mmap:
+            self._mmap.close()
+            self._mmap = None
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    
     def add_file_entry(self, path):
         """Add a file entry from file system to the 'entries' attribute.
 
@@ -106,70 +252,876 @@ class Sarc(object):
         Returns:
             None
         """
+        if self._is_excluded(path):
+            return False
+        self._insert_entry(self._new_file_entry(path))
+        return True
+    _add_file_entry = add_file_entry
+    
+    
+    def add_file_entries(self, paths, jobs=1):
+        """Add file entries from file system using a pool of threads.
+        
+        The names are hashed in one batch, then the files are stated and their
+        BFLIM footers read concurrently. Entries are inserted in the order of
+        'paths', so the result is the same as calling 'add_file_entry' for each path.
+
+        Args:
+            paths: Paths to the files.
+            jobs: Number of threads.
+
+        Returns:
+            Number of entries added.
+        """
+        stats = self.stats
+        if stats:
+            start = time.time()
+        paths = [p for p in paths if not self._is_excluded(p)]
+        hashes = calchash_batch([getrpath(self._base_path, p) for p in paths],
+                                self.fatheader.hash_key)
+        loaded = [self._new_file_entry(p, h) for p, h in zip(paths, hashes)]
+        if stats:
+            stats.add('hash', time.time() - start, count=len(loaded))
+            start = time.time()
+        
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                pool.map(Sarc.FATEntry.read_metadata, loaded)
+            finally:
+                pool.close()
+                pool.join()
+            if stats:
+                stats.add('metadata', time.time() - start, count=len(loaded))
+        for entry in loaded:
+            self._insert_entry(entry)
+        return len(loaded)
+    
+    
+    def add_tar(self, fileobj, close=False):
+        """Add file entries from the regular files in a tar archive.
+        
+        An uncompressed tar in a seekable file is used in place, the entries
+        point at the ranges of the file's contents in it. Other tars, compressed
+        or streamed, are read once, copying the contents into a single temporary
+        file. No files are extracted. The data is copied when archiving, so
+        the tar file must stay open until then.
+        
+        Args:
+            fileobj: File object of the tar archive.
+            close: Close 'fileobj' when the archive is closed.
+        
+        Returns:
+            Number of entries added.
+        """
+        if self.stats:
+            began = time.time()
+        members = []
+        source = None
+        try:
+            start = fileobj.tell()
+        except (AttributeError, IOError):
+            start = None
+        if start is not None:
+            try:
+                tar = tarfile.open(fileobj=fileobj, mode='r:')
+                members = [(m, m.offset_data) for m in tar.getmembers() if m.isreg()]
+                source = fileobj
+            except tarfile.ReadError:
+                fileobj.seek(start)
+        if source is None:
+            source = tempfile.TemporaryFile()
+            tar = tarfile.open(fileobj=fileobj, mode='r|*')
+            for m in tar:
+                if m.isreg():
+                    members.append((m, source.tell()))
+                    copy_stream(tar.extractfile(m), source, m.size)
+            self._sources.append(source)
+        elif close:
+            self._sources.append(source)
+        
+        names = []
+        for m, offset in members:
+            name = m.name[2:] if m.name.startswith('./') else m.name
+            names.append(name.lstrip('/'))
+        hashes = calchash_batch(names, self.fatheader.hash_key)
+        added = 0
+        for (m, offset), name, hash in zip(members, names, hashes):
+            if self._is_excluded(name):
+                continue
+            entry = Sarc.FATEntry(order=self.header.order, file_path=name,
+                                  hash_key=self.fatheader.hash_key, hash=hash, r_path=name)
+            entry.set_source(source, offset, m.size, m.mtime)
+            self._insert_entry(entry)
+            added += 1
+        if self.stats:
+            self.stats.add('tar', time.time() - began, sum(m.size for m, offset in members), added)
+        return added
+    
+    
+    def to_tar(self, fileobj, verbose=False):
+        """Write the archived files to a tar stream in FAT order.
+        
+        Args:
+            fileobj: Output file object. Only written to, so it can be a pipe.
+            verbose: Print verbose information.
+        
+        Returns:
+            Number of files written.
+        """
+        mtime = os.stat(self._path).st_mtime if self._path else time.time()
+        self.names
+        ranges = self._archived_ranges()
+        tar = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT)
+        for hash, name_offset, start, end in ranges:
+            info = tarfile.TarInfo(self._get_name(hash, name_offset))
+            info.size = end - start
+            info.mtime = mtime
+            info.mode = 0644
+            tar.addfile(info, Sarc.EntryFile(self.archive_data, start, end, info.name))
+            if verbose:
+                print >> sys.stderr, 'Converted:', info.name
+        tar.close()
+        return len(ranges)
+    
+    
+    def add_archive(self, other, hashes=None, on_conflict='error'):
+        """Add the archived files of another archive without extracting them.
+        
+        The entries point at the ranges of the contents in the other archive's
+        file, which are copied as they are when archiving, in hash order and
+        aligned again where BFLIM footers need it. Names are kept, and entries
+        stored without a name stay unnamed. The other archive must stay open
+        until then.
+        
+        An entry conflicts with an entry already added when they have the same
+        hash but different names, or the same name but different contents.
+        Identical entries are added once.
+        
+        Args:
+            other: Sarc instance of the archive.
+            hashes: Hashes of the entries to add, with the other archive's hash key.
+                    Default all archived entries.
+            on_conflict: 'error' to raise ValueError without adding anything,
+                         'first' to keep the entry already added, or 'last' to
+                         replace it.
+        
+        Returns:
+            List of (name, kind) tuples of the conflicting entries, where 'kind'
+            is 'hash' for different names and 'name' for different contents.
+        
+        Raises:
+            ValueError: Conflicting entries when 'on_conflict' is 'error', or
+                        unnamed entries to rehash for another hash key.
+        """
+        if on_conflict not in ('error', 'first', 'last'):
+            raise ValueError('Unknown conflict handling: %s'%on_conflict)
+        if other._path and not other._yaz0:
+            source = open(other._path, 'rb')
+            base = other.header.data_block_offset
+        else:
+            source = cStringIO.StringIO(other.archive_data)
+            base = 0
+        self._sources.append(source)
+        
+        hash_key = self.fatheader.hash_key
+        rehash = other.fatheader.hash_key != hash_key
+        added = {}
+        conflicts = []
+        for hash, name_offset, start, end in other._archived_ranges():
+            if hashes is not None and hash not in hashes:
+                continue
+            name = None
+            if name_offset & 0xff000000 or hash in other.name_map:
+                name = other._get_name(hash, name_offset)
+            if rehash:
+                if name is None:
+                    raise ValueError('Unnamed entry %08X can not be rehashed'%hash)
+                hash = calchash(name, hash_key)
+            entry = Sarc.FATEntry(order=self.header.order, file_path=name or UNNAMED_FORMAT%hash,
+                                  hash_key=hash_key, hash=hash, r_path=name or '')
+            entry.r_path = name
+            entry.set_source(source, base + start, end - start)
+            
+            existing = added.get(hash)
+            if existing is None and self.entries and hash in self.entries:
+                existing = self.entries[hash]
+            if existing is not None:
+                unnamed = UNNAMED_FORMAT%hash
+                if (self._entry_name(existing) or unnamed) != (name or unnamed):
+                    conflicts.append((name or unnamed, 'hash'))
+                elif (existing.type == Sarc.FATEntry.FILESYSTEM and
+                      existing.size == entry.size and existing.same_data(entry)):
+                    continue
+                else:
+                    conflicts.append((name or unnamed, 'name'))
+                if on_conflict == 'first':
+                    continue
+            added[hash] = entry
+        
+        if conflicts and on_conflict == 'error':
+            raise ValueError('Conflicting entries: %s'%', '.join(name for name, kind in conflicts))
+        for hash in sorted(added):
+            self._insert_entry(added[hash])
+        return conflicts
+    
+    
+    def split(self, max_entries=None):
+        """Split the entries into archives of at most 'max_entries' entries.
+        
+        Every part gets a consecutive range of hashes. Archived entries are
+        added with 'add_archive', so their contents are copied from this
+        archive when the parts are archived.
+        
+        Args:
+            max_entries: Maximum number of entries per part.
+                         Default 'FATBlockHeader._C_ARCHIVE_ENTRY_MAX'.
+        
+        Returns:
+            List of Sarc instances to archive.
+        """
+        max_entries = max_entries or Sarc.FATBlockHeader._C_ARCHIVE_ENTRY_MAX
+        hashes = sorted(set(self.entries or []))
+        parts = []
+        for start in range(0, len(hashes), max_entries):
+            chunk = set(hashes[start:start + max_entries])
+            part = Sarc(order=self.header.order, hash_key=self.fatheader.hash_key, stats=self.stats)
+            if isinstance(self.entries, Sarc.FATTable):
+                part.add_archive(self, chunk)
+            else:
+                if any(self.entries[h].type == Sarc.FATEntry.ARCHIVED for h in chunk):
+                    part.add_archive(self, chunk)
+                for h in sorted(chunk):
+                    if self.entries[h].type == Sarc.FATEntry.FILESYSTEM:
+                        part._insert_entry(self.entries[h])
+            parts.append(part)
+        return parts
+    
+    
+    def diff(self, other, jobs=1):
+        """Compare the archived files with those of another archive without extracting them.
+        
+        Both FATs are walked together in hash order. Entries with the same name
+        are compared by size, and when the sizes match, by the SHA-1 digests of
+        their data ranges. Members of 'DIFF_PARALLEL_SIZE' bytes or more are
+        digested by 'jobs' threads.
+        
+        Args:
+            other: Sarc instance of the newer archive.
+            jobs: Number of threads digesting large members.
+        
+        Returns:
+            Dict of the 'added', 'removed' and 'changed' entries and the number of
+            'unchanged' entries. Entries are dicts of 'name', 'hash' and 'size',
+            changed entries have 'old_size' and 'new_size' instead, and
+            'old_sha1' and 'new_sha1' when the sizes match.
+        
+        Raises:
+            ValueError: Unnamed entries to rehash for another hash key.
+        """
+        old = self._diff_entries(self.fatheader.hash_key)
+        new = other._diff_entries(self.fatheader.hash_key)
+        added = []
+        removed = []
+        changed = []
+        same_size = []
+        i = j = 0
+        while i < len(old) or j < len(new):
+            # An unnamed entry matches the entry with its hash whatever its name.
+            if (i < len(old) and j < len(new) and old[i][0] == new[j][0] and
+                (old[i][1] == new[j][1] or old[i][1] is None or new[j][1] is None)):
+                if old[i][3] - old[i][2] != new[j][3] - new[j][2]:
+                    changed.append({'name': old[i][1] or new[j][1], 'hash': old[i][0],
+                                    'old_size': old[i][3] - old[i][2],
+                                    'new_size': new[j][3] - new[j][2]})
+                else:
+                    same_size.append((old[i], new[j]))
+                i += 1
+                j += 1
+            elif j == len(new) or (i < len(old) and old[i][:2] < new[j][:2]):
+                removed.append(old[i])
+                i += 1
+            else:
+                added.append(new[j])
+                j += 1
+        
+        def digest(item):
+            data, start, end = item
+            return hashlib.sha1(view(data, start, end)).hexdigest()
+        
+        ranges = []
+        for a, b in same_size:
+            ranges.append((self.archive_data, a[2], a[3]))
+            ranges.append((other.archive_data, b[2], b[3]))
+        digests = [None] * len(ranges)
+        large = [k for k, r in enumerate(ranges) if r[2] - r[1] >= DIFF_PARALLEL_SIZE]
+        if jobs > 1 and len(large) > 1:
+            pool = ThreadPool(jobs)
+            try:
+                for k, d in zip(large, pool.map(digest, [ranges[k] for k in large])):
+                    digests[k] = d
+            finally:
+                pool.close()
+                pool.join()
+        digests = [d or digest(r) for d, r in zip(digests, ranges)]
+        unchanged = 0
+        for (a, b), old_sha1, new_sha1 in zip(same_size, digests[0::2], digests[1::2]):
+            if old_sha1 == new_sha1:
+                unchanged += 1
+            else:
+                changed.append({'name': a[1] or b[1], 'hash': a[0],
+                                'old_size': a[3] - a[2], 'new_size': b[3] - b[2],
+                                'old_sha1': old_sha1, 'new_sha1': new_sha1})
+        
+        for e in changed:
+            e['name'] = e['name'] or UNNAMED_FORMAT%e['hash']
+        entry = lambda e: {'name': e[1] or UNNAMED_FORMAT%e[0], 'hash': e[0], 'size': e[3] - e[2]}
+        changed.sort(key=lambda e: (e['hash'], e['name']))
+        return {'added': [entry(e) for e in added],
+                'removed': [entry(e) for e in removed],
+                'changed': changed,
+                'unchanged': unchanged}
+    
+    
+    def _diff_entries(self, hash_key):
+        # Get (hash, name, data start, data end) of the archived entries sorted by
+        # hash and name, with hashes for 'hash_key'. Unnamed entries have no name.
+        self.names
+        rehash = self.fatheader.hash_key != hash_key
+        entries = []
+        for hash, name_offset, start, end in self._archived_ranges():
+            name = None
+            if name_offset & 0xff000000 or hash in self.name_map:
+                name = self._get_name(hash, name_offset)
+            if rehash:
+                if name is None:
+                    raise ValueError('Unnamed entry %08X can not be rehashed'%hash)
+                hash = calchash(name, hash_key)
+            entries.append((hash, name, start, end))
+        entries.sort()
+        return entries
+    
+    
+    def _archived_ranges(self):
+        # Get (hash, name offset, data start, data end) of the archived entries in FAT order.
+        if isinstance(self.entries, Sarc.FATTable):
+            table = self.entries
+            return [(int(table.hashes[i]), int(table.name_offsets[i]),
+                     int(table.start_offsets[i]), int(table.end_offsets[i]))
+                    for i in range(len(table))]
+        return [(e.hash, e.name_offset, e.data_start_offset, e.data_end_offset)
+                for e in (self.entries[k] for k in sorted(self.entries or {}))
+                if e.type == Sarc.FATEntry.ARCHIVED]
+    
+    
+    def _is_excluded(self, path):
         for pat in self.exclude:
             if fnmatch.fnmatch(path, pat):
-                return False
-        entry = Sarc.FATEntry(order=self.header.order,
-                              base_path=self._base_path,
-                              file_path=path,
-                              hash_key=self.fatheader.hash_key)
+                return True
+        return False
+    
+    
+    def _new_file_entry(self, path, hash=None):
+        return Sarc.FATEntry(order=self.header.order,
+                             base_path=self._base_path,
+                             file_path=path,
+                             hash_key=self.fatheader.hash_key,
+                             hash=hash)
+    
+    
+    def _insert_entry(self, entry):
+        if isinstance(self.entries, Sarc.FATTable):
+            self.entries = {h:self.entries[h] for h in self.entries}
         if self.entries:
             self.entries[entry.hash] = entry
         else:
             self.entries = {entry.hash:entry}
-        return True
-    _add_file_entry = add_file_entry
     
     
-    def archive(self, archive_path, verbose=False):
-        """Archive the Sarc class instance to a binary file.
+    def plan_layout(self, dedup=False):
+        """Compute the layout of the archive without reading file bodies.
+        
+        Assigns the name and data offsets of every entry from the file sizes and
+        BFLIM footers, and updates 'file_count', 'data_block_offset' and 'file_size'.
         
         Args:
-            archive_path: Path to output.
-            verbose: Print verbose information.
+            dedup: Point entries with identical contents at a single data range.
+                   Only files of the same size are read, to compare their contents.
         
         Returns:
-            None
+            Entries sorted by hash and the padded file names appended to the FNT.
         """
         fnt_list = []
-        data_list = []
-        packed_fat_entries = []
         cur_fnt_offset = len(self.fnt_data)
         cur_data_offset = len(self.archive_data)
-        sorted_entries = [self.entries[k] for k in sorted(self.entries.keys())]
+        sorted_entries = [self.entries[k] for k in sorted((self.entries or {}).keys())]
         
         for e in sorted_entries:
-            cur_fnt_offset, cur_data_offset = e.archive(
-                                            fnt_list,
-                                            data_list,
-                                            cur_fnt_offset,
-                                            cur_data_offset)
-            packed_fat_entries.append(e.pack())
-            self.fatheader.file_count += 1
-            if verbose:
-                print 'Archived:', e.r_path
+            e.duplicate_of = None
+        if dedup:
+            self._find_duplicates(sorted_entries)
+        for e in sorted_entries:
+            if e.duplicate_of:
+                e.data_start_offset = e.duplicate_of.data_start_offset
+                e.data_end_offset = e.duplicate_of.data_end_offset
+                cur_fnt_offset = e.plan_name(fnt_list, cur_fnt_offset)
+                continue
+            cur_fnt_offset, cur_data_offset = e.plan(fnt_list,
+                                                     cur_fnt_offset,
+                                                     cur_data_offset)
+        self.fatheader.file_count = len(sorted_entries)
+        
+        meta_size = (self.header.header_size + self.fatheader.header_size +
+                     len(sorted_entries) * Sarc.FATEntry.C_STRUCTURE_SIZE +
+                     Sarc.FNTBlockHeader.C_STRUCTURE_SIZE + cur_fnt_offset)
+        self.header.data_block_offset = align(meta_size, 0x100)
+        self.header.file_size = self.header.data_block_offset + cur_data_offset
+        return sorted_entries, fnt_list
+    
+    
+    def _find_duplicates(self, sorted_entries):
+        # Set 'duplicate_of' of every file system entry whose contents are identical
+        # to an earlier entry. Files are grouped by size, then by digest, and a match
+        # is confirmed byte for byte. Identical contents have the same BFLIM footer,
+        # so the shared data range meets the alignment of every entry pointing at it.
+        by_size = {}
+        for e in sorted_entries:
+            if e.type != Sarc.FATEntry.FILESYSTEM:
+                continue
+            if e.size is None:
+                e.read_metadata()
+            if e.size:
+                by_size.setdefault(e.size, []).append(e)
+        for group in by_size.values():
+            if len(group) < 2:
+                continue
+            by_digest = {}
+            for e in group:
+                if not e.digest:
+                    e.digest = e.data_digest()
+                for original in by_digest.setdefault(e.digest, []):
+                    if e.same_data(original):
+                        e.duplicate_of = original
+                        break
+                else:
+                    by_digest[e.digest].append(e)
+    
+    
+    def archive_size(self, dedup=False):
+        """Get the size of the archive 'archive' would write, without writing it.
+        
+        Args:
+            dedup: Get the size with entries of identical contents sharing their data.
+        
+        Returns:
+            Archive file size.
+        """
+        self.plan_layout(dedup)
+        return self.header.file_size
+    
+    
+    def archive(self, archive_path, verbose=False, cache=False, yaz0_level=None, dedup=False):
+        """Archive the Sarc class instance to a binary file.
+        
+        Args:
+            archive_path: Path to output.
+            verbose: Print verbose information.
+            cache: Keep a build manifest next to the output, and reuse the data of
+                   unchanged files from the previous archive instead of reading them.
+                   Ignored when compressing, for archives initialized with an
+                   archive file, and for files added from tars or other archives.
+            yaz0_level: Compress the archive with Yaz0 at this level, from 0 to 9.
+                        Default no compression.
+            dedup: Store the contents of files with identical contents once, and
+                   point all their entries at it.
+        
+        Returns:
+            False if the archive was up to date and not written, otherwise True.
+        
+        Raises:
+            ValueError: When 'yaz0_level' is out of range.
+        """
+        stats = self.stats
+        manifest = None
+        if yaz0_level is not None:
+            if yaz0_level not in range(len(YAZ0_LEVELS)):
+                raise ValueError('Invalid Yaz0 level: %r'%(yaz0_level,))
+            cache = False
+        if cache and (self.fnt_data or self.archive_data or
+                      any(e.type != Sarc.FATEntry.FILESYSTEM or e.source
+                          for e in (self.entries or {}).values())):
+            # Only files read from their paths can be reused from a previous build,
+            # not archived entries or contents taken from a tar or another archive.
+            cache = False
+        if cache:
+            if stats:
+                start = time.time()
+            manifest = self._load_manifest(archive_path, dedup)
+            unchanged = self._reuse_cached_data(archive_path, manifest)
+            if stats:
+                stats.add('cache', time.time() - start, count=len(self.entries or {}))
+            if unchanged:
+                self.header.data_block_offset = manifest['data_block_offset']
+                self.header.file_size = manifest['archive_size']
+                if verbose:
+                    print 'Up to date:', archive_path
+                self._save_manifest(archive_path, dedup)
+                return False
+        
+        if stats:
+            start = time.time()
+        sorted_entries, fnt_list = self.plan_layout(dedup)
+        if stats:
+            stats.add('plan', time.time() - start, count=len(sorted_entries))
         
         if self.fatheader.file_count > Sarc.FATBlockHeader._C_ARCHIVE_ENTRY_MAX:
             print 'WARNING: File entries exceed.'
         
-        archived_data = ''.join([self.header.pack(), self.fatheader.pack()])
-        archived_data += ''.join(packed_fat_entries)
-        archived_data += Sarc.FNTBlockHeader(order=self.header.order).pack()
-        archived_data += self.fnt_data + ''.join(fnt_list)
-        archived_data += (align(len(archived_data), 0x100) - len(archived_data)) * '\x00' #Dumn
-        self.header.data_block_offset = len(archived_data)
+        if stats:
+            start = time.time()
+        # Replace an existing archive only when the new one is complete, it may be
+        # the archive or one of the archives the entries are read from.
+        if manifest or os.path.exists(archive_path):
+            output_path = archive_path + '.tmp'
+        else:
+            output_path = archive_path
+        if yaz0_level is not None:
+            archive_file = cStringIO.StringIO()
+        else:
+            archive_file = open(output_path, 'wb')
+        self._write_blocks(archive_file, sorted_entries, [self.fnt_data] + fnt_list)
+        archive_file.write(self.archive_data)
+        if stats:
+            stats.add('pack', time.time() - start, archive_file.tell())
+        cur_data_offset = len(self.archive_data)
+        ahead = []
+        if self.jobs > 1:
+            ahead = [entry for entry in sorted_entries if entry.type == Sarc.FATEntry.FILESYSTEM and
+                     not entry.duplicate_of and not entry.source and entry.size <= READ_AHEAD_FILE_SIZE]
+        ahead_ids = set(id(entry) for entry in ahead)
+        contents = self._read_ahead(ahead, self.jobs)
+        try:
+            for e in sorted_entries:
+                if e.duplicate_of:
+                    e.digest = e.duplicate_of.digest
+                    if verbose:
+                        print 'Deduplicated:', e.r_path, '->', e.duplicate_of.r_path
+                elif e.type == Sarc.FATEntry.FILESYSTEM:
+                    data = next(contents) if id(e) in ahead_ids else None
+                    if stats:
+                        start = time.time()
+                    archive_file.write((e.data_start_offset - cur_data_offset) * '\x00')
+                    if stats:
+                        stats.add('padding', time.time() - start, e.data_start_offset - cur_data_offset)
+                        start = time.time()
+                    digest = hashlib.sha1() if cache and not e.digest else None
+                    e.write_data(archive_file, digest, data)
+                    if digest:
+                        e.digest = digest.hexdigest()
+                    cur_data_offset = e.data_end_offset
+                    if stats:
+                        stats.add('write', time.time() - start, e.size, name=e.r_path)
+                    if verbose:
+                        print 'Archived:', e.r_path
+        finally:
+            contents.close()
+        if stats:
+            start = time.time()
+            size = archive_file.tell()
+        if yaz0_level is not None:
+            if verbose:
+                print 'Compressing:', archive_path
+            write_file(output_path, yaz0_compress(archive_file.getvalue(), yaz0_level))
+        archive_file.close()
+        
+        if output_path != archive_path:
+            if os.name == 'nt':
+                os.remove(archive_path)
+            os.rename(output_path, archive_path)
+        if cache:
+            self._save_manifest(archive_path, dedup)
+        if stats:
+            if yaz0_level is not None:
+                stats.add('compress', time.time() - start, size)
+            else:
+                stats.add('finish', time.time() - start)
+        return True
+    
+    
+    def _read_ahead(self, entries, jobs):
+        # Read the contents of 'entries' on 'jobs' threads ahead of writing them,
+        # yielding them in order. At most READ_AHEAD_SIZE bytes are read and not
+        # yet written, or a single file when it is larger.
+        if not entries:
+            return
+        stats = self.stats
         
-        archived_data += self.archive_data + ''.join(data_list)
-        self.header.file_size = len(archived_data)
+        def read(e):
+            if stats:
+                began = time.time()
+            data = e.read_data()
+            if stats:
+                stats.add('read', time.time() - began, len(data), name=e.r_path)
+            return data
         
-        archive_file = open(archive_path, 'wb')
-        archive_file.write(archived_data)
-        archive_file.seek(0, 0)
-        archive_file.write(self.header.pack())
-        archive_file.close()
+        pool = ThreadPool(jobs)
+        pending = collections.deque()
+        queued = 0
+        submitted = 0
+        try:
+            for e in entries:
+                while submitted < len(entries) and (
+                        not pending or queued + entries[submitted].size <= READ_AHEAD_SIZE):
+                    pending.append(pool.apply_async(read, (entries[submitted],)))
+                    queued += entries[submitted].size
+                    submitted += 1
+                data = pending.popleft().get()
+                queued -= e.size
+                yield data
+        finally:
+            pool.close()
+            pool.join()
+    
+    
+    def _load_manifest(self, archive_path, dedup=False):
+        try:
+            manifest = json.load(open(archive_path + MANIFEST_SUFFIX, 'r'))
+            st = os.stat(archive_path)
+        except (IOError, OSError, ValueError):
+            return None
+        if (manifest.get('version') != MANIFEST_VERSION or
+            manifest.get('order') != self.header.order or
+            manifest.get('hash_key') != self.fatheader.hash_key or
+            manifest.get('dedup', False) != dedup or
+            manifest.get('archive_size') != st.st_size or
+            manifest.get('archive_mtime') != st.st_mtime):
+            return None
+        return manifest
+    
+    
+    def _reuse_cached_data(self, archive_path, manifest):
+        # Point entries of unchanged files at their data in the previous archive.
+        # Files with a new mtime are only read when their size is unchanged, to
+        # compare digests. Returns True when nothing changed at all.
+        if not manifest:
+            return False
+        cached = {c['path']:c for c in manifest['entries']}
+        unchanged = len(cached) == len(self.entries or {})
+        for e in (self.entries or {}).values():
+            c = cached.get(e.r_path.decode('latin-1'))
+            st = os.stat(e.path)
+            e.mtime = st.st_mtime
+            if c is None or c['size'] != st.st_size:
+                unchanged = False
+                continue
+            if c['mtime'] != st.st_mtime and file_digest(e.path) != c['digest']:
+                unchanged = False
+                continue
+            e.path = archive_path
+            e.src_offset = manifest['data_block_offset'] + c['start']
+            e.data_start_offset = c['start']
+            e.data_end_offset = c['end']
+            e.size = c['size']
+            e.alignment = c['alignment']
+            e.digest = c['digest']
+        return unchanged
+    
     
+    def _save_manifest(self, archive_path, dedup=False):
+        st = os.stat(archive_path)
+        entries = sorted((self.entries or {}).values(), key=lambda e: e.r_path)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'order': self.header.order,
+            'hash_key': self.fatheader.hash_key,
+            'dedup': dedup,
+            'archive_size': st.st_size,
+            'archive_mtime': st.st_mtime,
+            'data_block_offset': self.header.data_block_offset,
+            'entries': [{'path': e.r_path.decode('latin-1'),
+                         'size': e.size,
+                         'mtime': e.mtime,
+                         'digest': e.digest,
+                         'hash': e.hash,
+                         'alignment': e.alignment,
+                         'start': e.data_start_offset,
+                         'end': e.data_end_offset} for e in entries],
+        }
+        fs = open(archive_path + MANIFEST_SUFFIX, 'w')
+        json.dump(manifest, fs, indent=1, sort_keys=True)
+        fs.close()
     
-    def extract(self, path, all=False, name=None, hash=0, save_file=True, verbose=False):
+    
+    def _write_blocks(self, fs, sorted_entries, fnt_list):
+        fs.write(self.header.pack())
+        fs.write(self.fatheader.pack())
+        fs.write(''.join([e.pack() for e in sorted_entries]))
+        fs.write(Sarc.FNTBlockHeader(order=self.header.order).pack())
+        for fnt_data in fnt_list:
+            fs.write(fnt_data)
+        fs.write((self.header.data_block_offset - fs.tell()) * '\x00') #Dumn
+    
+    
+    def update(self, files=None, remove=None, verbose=False):
+        """Add, replace or remove entries of the archive file in place.
+        
+        Only the header, FAT and FNT blocks and the data of the added files are
+        written. A replacing file is written over the data it replaces when it
+        fits there, other files are appended to the data block. The data block is
+        moved, with a single bulk copy by the kernel where supported, only when
+        the new FAT and FNT blocks don't fit in front of it. It is then moved far
+        enough to leave 'UPDATE_HEADROOM' bytes, or a quarter of the blocks' size,
+        for them to grow, so the following updates stay in place. Data left unused
+        by removed or replaced entries stays in the archive unless it is at the end
+        of the data block.
+        
+        Args:
+            files: Dict of file name in the archive to path of the file to add or replace.
+            remove: Names of the entries to remove.
+            verbose: Print verbose information.
+        
+        Returns:
+            True if the data block stayed in place, False if it was moved.
+        
+        Raises:
+            KeyError: When a name to remove doesn't exist.
+            ValueError: When the instance was not initialized with an archive file, or the
+                        archive is Yaz0 compressed.
+        """
+        if not self._path or not isinstance(self.entries, Sarc.FATTable):
+            raise ValueError('Only archives initialized with an archive file can be updated.')
+        if self._yaz0:
+            raise ValueError('Yaz0 compressed archives cannot be updated in place.')
+        files = files or {}
+        self.names
+        entries = []
+        by_name = {}
+        for i in range(len(self.entries)):
+            e = self.entries.entry(i)
+            e.r_path = None
+            if e.name_offset & 0xff000000:
+                e.r_path = self._get_name(e.hash, e.name_offset)
+                by_name[e.r_path] = e
+            entries.append(e)
+        
+        dropped = set()
+        for name in remove or []:
+            if name not in by_name:
+                raise KeyError(name)
+            dropped.add(id(by_name.pop(name)))
+        changes = []
+        for name in sorted(files):
+            new = Sarc.FATEntry(order=self.header.order,
+                                file_path=files[name],
+                                r_path=name,
+                                hash_key=self.fatheader.hash_key)
+            new.read_metadata()
+            old = by_name.pop(name, None)
+            if old is not None:
+                dropped.add(id(old))
+            changes.append((old, new))
+        kept = [entry for entry in entries if id(entry) not in dropped]
+        
+        # Write replacing files over the replaced data when they fit before the
+        # next entry and the replaced data isn't shared with a kept entry.
+        data_size = self.header.file_size - self.header.data_block_offset
+        starts = sorted(set(e.data_start_offset for e in entries))
+        placed = list(kept)
+        written = []
+        appended = []
+        for old, new in changes:
+            if old is not None and not any(k.data_start_offset < old.data_end_offset and
+                                           old.data_start_offset < k.data_end_offset
+                                           for k in kept):
+                next_start = bisect.bisect_right(starts, old.data_start_offset)
+                slot_end = starts[next_start] if next_start < len(starts) else data_size
+                start = new.align_offset(old.data_start_offset)
+                if start + new.size <= slot_end:
+                    new.data_start_offset = start
+                    new.data_end_offset = start + new.size
+                    placed.append(new)
+                    written.append(new)
+                    continue
+            appended.append(new)
+        cur_data_offset = max([p.data_end_offset for p in placed] + [0])
+        copy_size = min(cur_data_offset, data_size)
+        for new in appended:
+            cur_data_offset = new.align_offset(cur_data_offset)
+            new.data_start_offset = cur_data_offset
+            cur_data_offset += new.size
+            new.data_end_offset = cur_data_offset
+            written.append(new)
+        
+        live = placed + appended
+        live.sort(key=lambda e: (e.hash, e.r_path or ''))
+        fnt_list = []
+        cur_fnt_offset = 0
+        for e in live:
+            if e.r_path is not None:
+                cur_fnt_offset = e.plan_name(fnt_list, cur_fnt_offset)
+        self.fatheader.file_count = len(live)
+        meta_size = (self.header.header_size + self.fatheader.header_size +
+                     len(live) * Sarc.FATEntry.C_STRUCTURE_SIZE +
+                     Sarc.FNTBlockHeader.C_STRUCTURE_SIZE + cur_fnt_offset)
+        old_data_block_offset = self.header.data_block_offset
+        in_place = meta_size <= old_data_block_offset
+        if not in_place:
+            # Leave room for the FAT and FNT to grow, so the following updates
+            # stay in place, and keep the data block aligned for every BFLIM.
+            alignment = max([0x100] + [e.alignment for e in appended + written] +
+                            [self._archived_alignment(k) for k in kept])
+            self.header.data_block_offset = align(meta_size + max(UPDATE_HEADROOM, meta_size // 4),
+                                                  alignment)
+        self.header.file_size = (self.header.data_block_offset +
+                                 max([l.data_end_offset for l in live] + [0]))
+        
+        path = self._path
+        use_mmap = self._mmap is not None
+        self.close()
+        if in_place:
+            fs = open(path, 'r+b')
+        else:
+            fs = open(path + '.tmp', 'wb')
+            src = open(path, 'rb')
+            fs.seek(self.header.data_block_offset)
+            fs.flush()
+            copied = copy_range(src.fileno(), fs.fileno(), old_data_block_offset, copy_size)
+            if copied < copy_size:
+                src.seek(old_data_block_offset + copied)
+                fs.seek(self.header.data_block_offset + copied)
+                copy_stream(src, fs, copy_size - copied)
+            src.close()
+        for new in sorted(written, key=lambda e: e.data_start_offset):
+            fs.seek(self.header.data_block_offset + new.data_start_offset)
+            new.write_data(fs)
+            if verbose:
+                print 'Updated:', new.r_path
+        fs.truncate(self.header.file_size)
+        fs.seek(0)
+        self._write_blocks(fs, live, fnt_list)
+        fs.close()
+        if not in_place:
+            if os.name == 'nt':
+                os.remove(path)
+            os.rename(path + '.tmp', path)
+        if verbose:
+            for name in remove or []:
+                print 'Removed:', name
+        self._open_archive(path, use_mmap)
+        return in_place
+    
+    
+    def _archived_alignment(self, entry):
+        # Get the BFLIM alignment of an archived entry from the footer of its data.
+        start = max(entry.data_end_offset - Sarc.FATEntry._C_FOOTER_SIZE, entry.data_start_offset)
+        footer = str(view(self.archive_data, start, entry.data_end_offset))
+        size = entry.data_end_offset - entry.data_start_offset
+        if entry._is_bflim(footer, size):
+            return entry._read_bflim_alignment(footer)
+        return 0
+    
+    
+    def extract(self, path, all=False, name=None, hash=0, save_file=True, verbose=False, jobs=1):
         """Extract archived files.
 
         Args:
@@ -179,6 +1131,7 @@ class Sarc(object):
             hash: Hash of the file to extract. If 'name' argument is set, this argument will be ignored.
             save_file: Save the file to file system. False for listing file(s).
             verbose: Print verbose infomation.
+            jobs: Number of threads writing files when extracting all files.
 
         Returns:
             None
@@ -186,7 +1139,14 @@ class Sarc(object):
         Raises:
             KeyError: When input file name or hash doesn't exist.
         """
-        if all:
+        if all and save_file:
+            self._extract_all(path, verbose, jobs)
+        elif all and isinstance(self.entries, Sarc.FATTable):
+            self.names
+            for i in self.entries.sorted_indexes():
+                hash = int(self.entries.hashes[i])
+                print 'Hash: %08X  Path: %s'%(hash, self._get_name(hash, self.entries.name_offsets[i]))
+        elif all:
             for k in sorted(self.entries):
                 self.extract(path,
                              all=False,
@@ -196,78 +1156,344 @@ class Sarc(object):
                              verbose=verbose)
         else:
             if name:
-                hash = calchash(name, self.header.hash_key)
-            if hash:
-                r_path, full_path = self.entries[hash].extract(self.fnt_data,
-                                                               self.archive_data,
-                                                               path, save_file)
-                if save_file and full_path and verbose:
-                    print 'Saved:', full_path
-                elif not save_file and r_path:
-                    print 'Hash: %08X  Path: %s'%(hash, r_path)
-
+                entry = self.find(name)
+                if entry is None:
+                    raise KeyError(name)
+            elif hash:
+                entry = self.find_hash(hash)
+                if entry is None:
+                    raise KeyError(hash)
+            else:
+                return
+            if entry.type != Sarc.FATEntry.ARCHIVED:
+                return
+            r_path = self._get_name(entry.hash, entry.name_offset)
+            full_path = os.path.join(path, r_path)
+            if save_file:
+                if self.stats:
+                    began = time.time()
+                mkdirs(os.path.dirname(full_path))
+                self._save_range(full_path, entry.data_start_offset, entry.data_end_offset)
+                if self.stats:
+                    self.stats.add('extract', time.time() - began,
+                                   entry.data_end_offset - entry.data_start_offset, name=full_path)
+            if save_file and full_path and verbose:
+                print 'Saved:', full_path
+            elif not save_file and r_path:
+                print 'Hash: %08X  Path: %s'%(entry.hash, r_path)
     
-    class BlockHeader(object):
-        """Base class of blocks header.
+    
+    def find(self, name):
+        """Find a file entry by name.
         
-        Attributes:
-            signature: Signature of the class instance.
-            header_size: Header size of the class instance.
-            C_SIGNATURE: Constant signature value.
-            C_STRUCTURE_SIZE: Constant structure size.
+        Entries sharing the hash of 'name' are told apart by their FNT names.
+        
+        Args:
+            name: File name relative to the archive root.
+        
+        Returns:
+            FATEntry instance, or None when the file doesn't exist.
         """
+        return self.find_many([name])[0]
+    
+    
+    def _candidates(self, hash):
+        if isinstance(self.entries, Sarc.FATTable):
+            return [self.entries.entry(i) for i in self.entries.indexes_of(hash)]
+        entry = (self.entries or {}).get(hash)
+        return [entry] if entry else []
+    
+    
+    def _entry_name(self, entry):
+        if entry.type == Sarc.FATEntry.FILESYSTEM:
+            return entry.r_path
+        return self._get_name(entry.hash, entry.name_offset)
+    
+    
+    def find_many(self, names):
+        """Find file entries for many names, hashing them in one batch.
         
+        Args:
+            names: File names relative to the archive root.
         
-        def check_valid(self):
-            """Check if the class instance is valid.
-            
-            Raises:
-                ValueError: Error occurred when class attribute invalid.
-            """
-            if self.signature != self.C_SIGNATURE:
-                raise ValueError('Invalid signature ( except: "%s", actual: "%s" )'
-                                 %(self.C_SIGNATURE, self.signature))
-            if self.header_size != self.C_STRUCTURE_SIZE:
-                raise ValueError('Invalid header size ( except: %x, actual: %x )'
-                                 %(self.C_STRUCTURE_SIZE, self.header_size))
+        Returns:
+            List of FATEntry instances, or None for files that don't exist.
+        """
+        names = list(names)
+        ret = []
+        for name, hash in zip(names, calchash_batch(names, self.fatheader.hash_key)):
+            entry = None
+            for e in self._candidates(hash):
+                if self._entry_name(e) == name:
+                    entry = e
+                    break
+            ret.append(entry)
+        return ret
     
     
-    class ArchiveBlockHeader(BlockHeader):
-        """Archive block header class.
+    def find_hash(self, hash):
+        """Find a file entry by hash.
         
-        Attributes:
-            signature: Signature of the class instance.
-            header_size: Header size of the class instance.
-            bom: Byte-order mark. Always 0xfeff.
-            file_size: Archive file size.
-            data_block_offset: Data block offset relate to zero.
-            version: Archive version.
-            order: Byte order.
-            C_SIGNATURE: Constant signature value.
-            C_STRUCTURE_SIZE: Constant structure size.
-            HEADER_STRUCT: Structure of the binary archive's header.
+        Args:
+            hash: File name hash.
+        
+        Returns:
+            FATEntry instance, or None when the hash doesn't exist. Of entries
+            with the same hash, the last one, like 'entries[hash]'.
         """
-        HEADER_STRUCT = '4sHHIIHH'
-        C_STRUCTURE_SIZE = calcsize(HEADER_STRUCT)
-        C_SIGNATURE = 'SARC'
-        _C_ARCHIVE_VERSION = 0x0100
+        return (self.entries or {}).get(hash)
+    
+    
+    def open(self, name_or_hash):
+        """Open an archived file for reading without extracting it.
         
-        def __init__(self, data=None, order=''):
-            """Initialize ArchiveBlockHeader class.
-
-            Args:
-                data: Required only if you are initializing the Sarc class with an archive.
-                order: Required only if you are creating an archive. Must be '>' or '<'.
-
-            Returns:
-                None
-            """
-            if data:
-                bom = data[6:8]
-                self.order = '<' if (bom == '\xff\xfe') else '>'
-                (self.signature,
-                 self.header_size,
-                 self.bom,
+        The returned file reads straight from the archive data, the memory map
+        when the archive was opened with 'use_mmap', so it must not outlive 'close'.
+        
+        Args:
+            name_or_hash: File name, or file name hash.
+        
+        Returns:
+            Read-only, seekable EntryFile instance.
+        
+        Raises:
+            KeyError: When the file name or hash doesn't exist.
+        """
+        if isinstance(name_or_hash, (int, long)):
+            entry = self.find_hash(name_or_hash)
+        else:
+            entry = self.find(name_or_hash)
+        if entry is None or entry.type != Sarc.FATEntry.ARCHIVED:
+            raise KeyError(name_or_hash)
+        return Sarc.EntryFile(self.archive_data, entry.data_start_offset, entry.data_end_offset,
+                              self._get_name(entry.hash, entry.name_offset))
+    
+    
+    def recover_names(self, words, templates=None):
+        """Recover file names of the archived entries from candidate words.
+        
+        Args:
+            words: Candidate words.
+            templates: Name templates such as 'timg/{}.bflim'. Default the words themselves.
+        
+        Returns:
+            Dict of recovered hash to file name.
+        """
+        return recover_names(list(self.entries), self.fatheader.hash_key, words, templates)
+    
+    
+    @property
+    def names(self):
+        """File name table index, built on first use."""
+        if self._names is None:
+            self._names = Sarc.NameTable(self.fnt_data)
+        return self._names
+    
+    
+    def _get_name(self, hash, name_offset):
+        if not name_offset & 0xff000000:
+            return self.name_map.get(hash, UNNAMED_FORMAT%hash)
+        if self._names is not None:
+            return self._names.get_name(name_offset)
+        name_offset &= 0x00ffffff
+        return get_string(view(self.fnt_data, name_offset * Sarc.FATEntry._C_FNT_ALIGNMENT))
+    
+    
+    def _extract_all(self, path, verbose, jobs):
+        stats = self.stats
+        if stats:
+            began = time.time()
+        targets = []
+        self.names
+        if isinstance(self.entries, Sarc.FATTable):
+            table = self.entries
+            for i in table.sorted_indexes():
+                r_path = self._get_name(int(table.hashes[i]), table.name_offsets[i])
+                targets.append((os.path.join(path, r_path),
+                                table.start_offsets[i], table.end_offsets[i]))
+        else:
+            for k in sorted(self.entries):
+                e = self.entries[k]
+                if e.type == Sarc.FATEntry.ARCHIVED:
+                    targets.append((os.path.join(path, self._get_name(e.hash, e.name_offset)),
+                                    e.data_start_offset, e.data_end_offset))
+        
+        if stats:
+            stats.add('names', time.time() - began, count=len(targets))
+            began = time.time()
+        
+        # Create every output directory once before writing any file.
+        outdirs = sorted(set(os.path.dirname(t[0]) for t in targets))
+        for outdir in outdirs:
+            if outdir:
+                mkdirs(outdir)
+        if stats:
+            stats.add('mkdirs', time.time() - began, count=len(outdirs))
+        
+        def save(target):
+            outpath, start, end = target
+            if stats:
+                began = time.time()
+            self._save_range(outpath, start, end)
+            if stats:
+                stats.add('extract', time.time() - began, end - start, name=outpath)
+            return outpath
+        
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            saved = pool.imap(save, targets)
+        else:
+            pool = None
+            saved = (save(t) for t in targets)
+        try:
+            for outpath in saved:
+                if verbose:
+                    print 'Saved:', outpath
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+    
+    
+    def _save_range(self, outpath, start, end):
+        # Copy a range of the data block to a new file. With an archive file opened
+        # with 'use_mmap', the range is copied between the file descriptors by the
+        # kernel. What isn't copied that way is written in chunks from the data view.
+        fs = open(outpath, 'wb')
+        try:
+            if self._file:
+                start += copy_range(self._file.fileno(), fs.fileno(),
+                                    self.header.data_block_offset + start, end - start)
+            for pos in xrange(start, end, COPY_CHUNK_SIZE):
+                fs.write(view(self.archive_data, pos, min(pos + COPY_CHUNK_SIZE, end)))
+        finally:
+            fs.close()
+    
+    
+    class EntryFile(io.RawIOBase):
+        """Read-only file object over the data of an archived file.
+        
+        Attributes:
+            name: File name of the entry.
+            size: File size.
+        """
+        
+        def __init__(self, data, start, end, name=''):
+            io.RawIOBase.__init__(self)
+            self._data = data
+            self._start = start
+            self._pos = 0
+            self.size = end - start
+            self.name = name
+        
+        
+        def readable(self):
+            return True
+        
+        
+        def seekable(self):
+            return True
+        
+        
+        def readinto(self, b):
+            if self.closed:
+                raise ValueError('I/O operation on closed file.')
+            n = max(min(len(b), self.size - self._pos), 0)
+            start = self._start + self._pos
+            b[:n] = self._data[start:start + n]
+            self._pos += n
+            return n
+        
+        
+        def readall(self):
+            return self.read(max(self.size - self._pos, 0))
+        
+        
+        def seek(self, offset, whence=io.SEEK_SET):
+            if self.closed:
+                raise ValueError('I/O operation on closed file.')
+            if whence == io.SEEK_CUR:
+                offset += self._pos
+            elif whence == io.SEEK_END:
+                offset += self.size
+            elif whence != io.SEEK_SET:
+                raise ValueError('Invalid whence: %r'%whence)
+            if offset < 0:
+                raise IOError(errno.EINVAL, 'Negative seek position %d'%offset)
+            self._pos = offset
+            return self._pos
+        
+        
+        def tell(self):
+            return self._pos
+        
+        
+        def close(self):
+            self._data = None
+            io.RawIOBase.close(self)
+    
+    
+    class BlockHeader(object):
+        """Base class of blocks header.
+        
+        Attributes:
+            signature: Signature of the class instance.
+            header_size: Header size of the class instance.
+            C_SIGNATURE: Constant signature value.
+            C_STRUCTURE_SIZE: Constant structure size.
+        """
+        
+        
+        def check_valid(self):
+            """Check if the class instance is valid.
+            
+            Raises:
+                ValueError: Error occurred when class attribute invalid.
+            """
+            if self.signature != self.C_SIGNATURE:
+                raise ValueError('Invalid signature ( except: "%s", actual: "%s" )'
+                                 %(self.C_SIGNATURE, self.signature))
+            if self.header_size != self.C_STRUCTURE_SIZE:
+                raise ValueError('Invalid header size ( except: %x, actual: %x )'
+                                 %(self.C_STRUCTURE_SIZE, self.header_size))
+    
+    
+    class ArchiveBlockHeader(BlockHeader):
+        """Archive block header class.
+        
+        Attributes:
+            signature: Signature of the class instance.
+            header_size: Header size of the class instance.
+            bom: Byte-order mark. Always 0xfeff.
+            file_size: Archive file size.
+            data_block_offset: Data block offset relate to zero.
+            version: Archive version.
+            order: Byte order.
+            C_SIGNATURE: Constant signature value.
+            C_STRUCTURE_SIZE: Constant structure size.
+            HEADER_STRUCT: Structure of the binary archive's header.
+        """
+        HEADER_STRUCT = '4sHHIIHH'
+        C_STRUCTURE_SIZE = calcsize(HEADER_STRUCT)
+        C_SIGNATURE = 'SARC'
+        _C_ARCHIVE_VERSION = 0x0100
+        
+        def __init__(self, data=None, order=''):
+            """Initialize ArchiveBlockHeader class.
+
+            Args:
+                data: Required only if you are initializing the Sarc class with an archive.
+                order: Required only if you are creating an archive. Must be '>' or '<'.
+
+            Returns:
+                None
+            """
+            if data:
+                bom = data[6:8]
+                self.order = '<' if (bom == '\xff\xfe') else '>'
+                (self.signature,
+                 self.header_size,
+                 self.bom,
                  self.file_size,
                  self.data_block_offset,
                  self.version,
@@ -390,12 +1616,13 @@ class Sarc(object):
         ENTYR_STRUCT = 'IIII'
         C_STRUCTURE_SIZE = calcsize(ENTYR_STRUCT)
         _C_FNT_ALIGNMENT = 4
+        _C_FOOTER_SIZE = 0x28
         
         ARCHIVED = 0
         FILESYSTEM = 1
         
         def __init__(self, data=None, order='', base_path='',
-                     file_path='', hash_key=DEFAULT_HASH_KEY):
+                     file_path='', hash_key=DEFAULT_HASH_KEY, hash=None, r_path=None):
             self.order = order
             if data:
                 self.type = self.ARCHIVED
@@ -408,15 +1635,23 @@ class Sarc(object):
             else:
                 self.type = self.FILESYSTEM
                 self.path = file_path
-                self.r_path = getrpath(base_path, file_path)
-                self.hash = calchash(self.r_path, hash_key)
+                self.r_path = getrpath(base_path, file_path) if r_path is None else r_path
+                self.hash = calchash(self.r_path, hash_key) if hash is None else hash
                 self.name_offset = 0
                 self.data_start_offset = 0
                 self.data_end_offset = 0
+                self.src_offset = 0
+                self.size = None
+                self.footer = ''
+                self.alignment = 0
+                self.mtime = None
+                self.digest = None
+                self.source = None
+            self.duplicate_of = None
         
         
-        def _align_data(self, data, cur_pos):
-            if self._is_bflim(data):
+        def _align_data(self, data, cur_pos, size=None):
+            if self._is_bflim(data, size):
                 alignment = self._read_bflim_alignment(data)
                 return align(cur_pos, alignment) - cur_pos
             else:
@@ -427,9 +1662,11 @@ class Sarc(object):
             return align(len(fn), alignment) - len(fn)
         
         
-        def _is_bflim(self, data):
+        def _is_bflim(self, data, size=None):
+            if size is None:
+                size = len(data)
             return ((data[-0x28:-0x24] == 'FLIM') and
-                    (len(data) == unpack(self.order + 'I', data[-0x1C:-0x18])[0]))
+                    (size == unpack(self.order + 'I', data[-0x1C:-0x18])[0]))
         
 
         def _is_bflan(self, data):
@@ -440,30 +1677,193 @@ class Sarc(object):
             return unpack(self.order + 'H', data[-8:-6])[0]
         
         
-        def archive(self, fnt_list, data_list, cur_fnt_offset, cur_data_offset):
+        def read_metadata(self):
+            """Read the size and the BFLIM footer of a file system entry.
+            
+            Only the last 0x28 bytes of the file are read.
+            """
+            st = os.stat(self.path)
+            self.size = st.st_size
+            self.mtime = st.st_mtime
+            fs = open(self.path, 'rb')
+            fs.seek(max(self.size - self._C_FOOTER_SIZE, 0))
+            self.footer = fs.read(self._C_FOOTER_SIZE)
+            fs.close()
+            if self._is_bflim(self.footer, self.size):
+                self.alignment = self._read_bflim_alignment(self.footer)
+        
+        
+        def set_source(self, source, offset, size, mtime=None):
+            """Take the contents of a file system entry from a range of an open file.
+            
+            The entry reads its data from 'source' instead of opening 'path',
+            which is only used in messages.
+            
+            Args:
+                source: Seekable file object, kept open until the archive is written.
+                offset: Offset of the contents in 'source'.
+                size: Size of the contents.
+                mtime: Modification time.
+            """
+            self.source = source
+            self.src_offset = offset
+            self.size = size
+            self.mtime = mtime
+            source.seek(offset + max(size - self._C_FOOTER_SIZE, 0))
+            self.footer = source.read(min(size, self._C_FOOTER_SIZE))
+            self.alignment = 0
+            if self._is_bflim(self.footer, self.size):
+                self.alignment = self._read_bflim_alignment(self.footer)
+        
+        
+        def open_data(self):
+            """Get a file object positioned at the contents of a file system entry.
+            
+            Close it with 'close_data'.
+            """
+            if self.source:
+                self.source.seek(self.src_offset)
+                return self.source
+            fs = open(self.path, 'rb')
+            fs.seek(self.src_offset)
+            return fs
+        
+        
+        def close_data(self, fs):
+            if fs is not self.source:
+                fs.close()
+        
+        
+        def data_digest(self):
+            """Calculate the SHA-1 digest of the contents of a file system entry."""
+            fs = self.open_data()
+            digest = stream_digest(fs, self.size)
+            self.close_data(fs)
+            return digest
+        
+        
+        def align_offset(self, cur_pos):
+            """Get the first data block offset from 'cur_pos' the entry's data can start at."""
+            return align(cur_pos, self.alignment) if self.alignment else cur_pos
+        
+        
+        def plan(self, fnt_list, cur_fnt_offset, cur_data_offset):
+            """Assign the name and data offsets of a file system entry.
+            
+            Args:
+                fnt_list: List to append the padded file name to.
+                cur_fnt_offset: Current offset in the file name table.
+                cur_data_offset: Current offset in the file data block.
+            
+            Returns:
+                Next file name table offset and next file data block offset.
+            """
             if self.type == self.ARCHIVED:
                 return cur_fnt_offset, cur_data_offset
             elif self.type == self.FILESYSTEM:
-                file_data = open(self.path, 'rb').read()
-                feed = self._align_data(file_data, cur_data_offset)
-                if feed > 0:
-                    data_list.append(feed * '\x00')
-                    cur_data_offset += feed
-                data_list.append(file_data)
+                if self.size is None:
+                    self.read_metadata()
+                cur_data_offset = self.align_offset(cur_data_offset)
                 
                 self.data_start_offset = cur_data_offset
-                self.data_end_offset = cur_data_offset + len(file_data)
-                self.name_offset = ((cur_fnt_offset / self._C_FNT_ALIGNMENT)
-                                    & 0x00ffffff) | (1 << 24) # Always (1 << 24) ?
-                
-                r_path = self.r_path + '\x00'
-                r_path += self._align_fn(r_path, self._C_FNT_ALIGNMENT) * '\x00'
-                cur_fnt_offset += len(r_path)
-                fnt_list.append(r_path)
+                self.data_end_offset = cur_data_offset + self.size
+                cur_fnt_offset = self.plan_name(fnt_list, cur_fnt_offset)
                 
                 return cur_fnt_offset, self.data_end_offset
         
         
+        def plan_name(self, fnt_list, cur_fnt_offset):
+            """Assign the name offset of the entry and append its name to the FNT.
+            
+            Args:
+                fnt_list: List to append the padded file name to.
+                cur_fnt_offset: Current offset in the file name table.
+            
+            Returns:
+                Next file name table offset.
+            """
+            if self.r_path is None:
+                # Entry added from an archive without its name.
+                self.name_offset = 0
+                return cur_fnt_offset
+            self.name_offset = ((cur_fnt_offset / self._C_FNT_ALIGNMENT)
+                                & 0x00ffffff) | (1 << 24) # Always (1 << 24) ?
+            
+            r_path = self.r_path + '\x00'
+            r_path += self._align_fn(r_path, self._C_FNT_ALIGNMENT) * '\x00'
+            fnt_list.append(r_path)
+            return cur_fnt_offset + len(r_path)
+        
+        
+        def write_data(self, fs, digest=None, data=None):
+            """Copy the contents of a file system entry to 'fs'.
+            
+            Args:
+                fs: Output file object positioned at 'data_start_offset'.
+                digest: hashlib object to update with the contents.
+                data: Contents already read by 'read_data', written instead of
+                      reading them.
+            
+            Raises:
+                IOError: When the file size changed after the layout was planned.
+            """
+            if self.type == self.FILESYSTEM and data is not None:
+                if len(data) != self.data_end_offset - self.data_start_offset:
+                    raise IOError('File changed while archiving: %s'%self.path)
+                fs.write(data)
+                if digest:
+                    digest.update(data)
+            elif self.type == self.FILESYSTEM:
+                size = self.data_end_offset - self.data_start_offset
+                src = self.open_data()
+                copied = 0
+                if digest is None and isinstance(src, file) and isinstance(fs, file):
+                    # Copy within the kernel, and the rest in chunks if it stopped early.
+                    fs.flush()
+                    pos = fs.tell()
+                    copied = copy_range(src.fileno(), fs.fileno(), self.src_offset, size)
+                    fs.seek(pos + copied)
+                    src.seek(self.src_offset + copied)
+                copied += copy_stream(src, fs, size - copied, digest)
+                changed = copied != size or (not self.source and not self.src_offset and src.read(1))
+                self.close_data(src)
+                if changed:
+                    raise IOError('File changed while archiving: %s'%self.path)
+        
+        
+        def read_data(self):
+            """Read the contents of a file system entry into memory.
+            
+            A file read from its start is read one byte past its planned size,
+            so 'write_data' notices that it grew.
+            """
+            fs = self.open_data()
+            data = fs.read(self.size + (0 if self.source or self.src_offset else 1))
+            self.close_data(fs)
+            return data
+        
+        
+        def same_data(self, other):
+            """Compare the contents of two file system entries byte for byte."""
+            if self.size != other.size:
+                return False
+            a = self.open_data()
+            b = other.open_data()
+            pos = 0
+            same = True
+            while same and pos < self.size:
+                # Seek before every read, the entries may share a source file.
+                chunk_size = min(COPY_CHUNK_SIZE, self.size - pos)
+                a.seek(self.src_offset + pos)
+                chunk = a.read(chunk_size)
+                b.seek(other.src_offset + pos)
+                same = chunk == b.read(chunk_size)
+                pos += chunk_size
+            self.close_data(a)
+            other.close_data(b)
+            return same
+        
+        
         def check_valid(self):
             pass
         _check_valid = check_valid
@@ -471,21 +1871,37 @@ class Sarc(object):
         
         def extract(self, fnt_data, archive_data, path, save_file):
             if self.type == self.ARCHIVED:
-                name_offset = self.name_offset & 0x00ffffff
-                r_path = get_string(fnt_data[name_offset * self._C_FNT_ALIGNMENT:])
+                r_path = self.get_name(fnt_data)
                 
                 outpath = os.path.join(path, r_path)
                 outdir, name = os.path.split(outpath)
                 
                 if save_file:
                     mkdirs(outdir)
-                    data = archive_data[self.data_start_offset:self.data_end_offset]
+                    data = view(archive_data, self.data_start_offset, self.data_end_offset)
                     write_file(outpath, data)
                 return r_path, outpath
             else:
                 return '', ''
         
         
+        def get_name(self, fnt_data):
+            """Get the file name of an archived entry.
+            
+            Args:
+                fnt_data: Binary File Name Table (FNT) data, or a NameTable of it.
+            
+            Returns:
+                File name relative to the archive root.
+            """
+            if not self.name_offset & 0xff000000:
+                return UNNAMED_FORMAT%self.hash
+            if isinstance(fnt_data, Sarc.NameTable):
+                return fnt_data.get_name(self.name_offset)
+            name_offset = self.name_offset & 0x00ffffff
+            return get_string(view(fnt_data, name_offset * self._C_FNT_ALIGNMENT))
+        
+        
         def pack(self):
             """Pack the class instance to a str according to 'HEADER_STRUCT'.
             
@@ -499,6 +1915,176 @@ class Sarc(object):
                         self.data_start_offset, self.data_end_offset)
     
     
+    class FATTable(object):
+        """Array-backed file entry table.
+        
+        A read-only mapping of hash to FATEntry. The FAT block is decoded in one
+        pass into parallel arrays, FATEntry instances are only created when an
+        entry is looked up. Lookups bisect the hashes, which archives store in
+        ascending order. Of entries with the same hash, lookups get the last one,
+        while iterating gets all of them in FAT order.
+        
+        Attributes:
+            hashes: File name hashes.
+            name_offsets: File name offsets.
+            start_offsets: File data start offsets.
+            end_offsets: File data end offsets.
+            order: Byte order.
+        """
+        
+        def __init__(self, data, offset, count, order):
+            self.order = order
+            raw = data[offset:offset + count * Sarc.FATEntry.C_STRUCTURE_SIZE]
+            if numpy is not None:
+                table = numpy.frombuffer(raw, dtype=order + 'u4').reshape(count, 4)
+                columns = [table[:, i] for i in range(4)]
+            else:
+                words = array.array(UINT32_TYPECODE, raw)
+                if (order == '<') != (sys.byteorder == 'little'):
+                    words.byteswap()
+                columns = [words[i::4] for i in range(4)]
+            (self.hashes,
+             self.name_offsets,
+             self.start_offsets,
+             self.end_offsets) = columns
+        
+        
+        def __len__(self):
+            return len(self.hashes)
+        
+        
+        def __iter__(self):
+            return iter(self.hashes.tolist())
+        
+        
+        def __contains__(self, hash):
+            return len(self.indexes_of(hash)) > 0
+        
+        
+        def __getitem__(self, hash):
+            indexes = self.indexes_of(hash)
+            if not indexes:
+                raise KeyError(hash)
+            return self.entry(indexes[-1])
+        
+        
+        def get(self, hash, default=None):
+            indexes = self.indexes_of(hash)
+            return self.entry(indexes[-1]) if indexes else default
+        
+        
+        def _bisect(self, hash, side):
+            if numpy is not None and isinstance(self.hashes, numpy.ndarray):
+                return int(numpy.searchsorted(self.hashes, hash, side))
+            if side == 'left':
+                return bisect.bisect_left(self.hashes, hash)
+            return bisect.bisect_right(self.hashes, hash)
+        
+        
+        def indexes_of(self, hash):
+            """Find the entries with a hash by bisecting the hash-sorted FAT.
+            
+            Args:
+                hash: File name hash.
+            
+            Returns:
+                Indexes of the entries with 'hash', empty if there is none.
+            """
+            start = self._bisect(hash, 'left')
+            if start == len(self) or self.hashes[start] != hash:
+                return range(0)
+            return range(start, self._bisect(hash, 'right'))
+        
+        
+        def keys(self):
+            return self.hashes.tolist()
+        
+        
+        def values(self):
+            return [self.entry(i) for i in range(len(self))]
+        
+        
+        def items(self):
+            return zip(self.keys(), self.values())
+        
+        
+        def iterkeys(self):
+            return iter(self)
+        
+        
+        def itervalues(self):
+            return (self.entry(i) for i in xrange(len(self)))
+        
+        
+        def iteritems(self):
+            return ((int(self.hashes[i]), self.entry(i)) for i in xrange(len(self)))
+        
+        
+        def sorted_indexes(self):
+            """Get entry indexes ordered by hash.
+            
+            Returns:
+                List of indexes. Entries with the same hash keep their FAT order.
+            """
+            hashes = self.hashes.tolist()
+            if all(hashes[i] <= hashes[i + 1] for i in range(len(hashes) - 1)):
+                return range(len(hashes))
+            return sorted(range(len(hashes)), key=hashes.__getitem__)
+        
+        
+        def entry(self, index):
+            """Create a FATEntry for the entry at 'index'.
+            
+            Args:
+                index: Index of the entry in the FAT block.
+            
+            Returns:
+                FATEntry instance.
+            """
+            return Sarc.FATEntry(data=pack(self.order + Sarc.FATEntry.ENTYR_STRUCT,
+                                           int(self.hashes[index]),
+                                           int(self.name_offsets[index]),
+                                           int(self.start_offsets[index]),
+                                           int(self.end_offsets[index])),
+                                 order=self.order)
+    
+    
+    class NameTable(object):
+        """File name table index.
+        
+        Splits the FNT data once and maps the offset of every name to the name,
+        so names don't have to be scanned out of the FNT one entry at a time.
+        
+        Attributes:
+            names: Dict of FNT byte offset to file name.
+        """
+        
+        def __init__(self, fnt_data):
+            self._fnt_data = fnt_data
+            self.names = {}
+            pos = 0
+            for name in str(fnt_data).split('\x00'):
+                if name:
+                    self.names[pos] = name
+                pos += len(name) + 1
+        
+        
+        def get_name(self, name_offset):
+            """Get a file name by the name offset of its FAT entry.
+            
+            Args:
+                name_offset: 'name_offset' of a FATEntry.
+            
+            Returns:
+                File name.
+            """
+            pos = (name_offset & 0x00ffffff) * Sarc.FATEntry._C_FNT_ALIGNMENT
+            name = self.names.get(pos)
+            if name is None:
+                name = get_string(view(self._fnt_data, pos))
+            return name
+    
+    
     class FNTBlockHeader(BlockHeader):
         HEADER_STRUCT = '4sHH'
         C_STRUCTURE_SIZE = calcsize(HEADER_STRUCT)
@@ -540,41 +2126,1181 @@ class Sarc(object):
                         self.signature, self.header_size, 0)
     
     
-def align(value, alignment):
-    return (value + alignment -1) / alignment * alignment
-
-
-def calchash(data, key):
-    """Calculate file name hash.
+class Stats(object):
+    """Time, bytes and counts recorded per phase of creating or extracting archives.
     
-    Args:
-        data: File name data.
-        key: Hash key.
+    Pass an instance as 'stats' to Sarc, or to the helper methods, to record;
+    nothing is measured without one. Subclass it and override 'add' to get a
+    callback for every measurement instead.
     
-    Returns:
-        Hash value.
+    Phases are 'walk', 'hash' and 'metadata' (with threads) when adding files
+    from a directory; 'tar' when adding files from a tar archive; 'cache',
+    'plan' (file metadata, alignment and FNT), 'pack' (headers, FAT and FNT),
+    'read' (files read ahead, with threads), 'padding', 'write' and 'finish'
+    or 'compress' when archiving; 'open' when
+    opening an archive; and 'names', 'mkdirs' and 'extract' when extracting.
+    
+    Attributes:
+        phases: Ordered dict of phase name to a dict of 'seconds', 'bytes' and 'count'.
+        entries: List of (phase, name, seconds, bytes) per file, if 'per_entry' is set.
+        per_entry: Record every file in 'entries'.
     """
-    ret = 0
-    for c in data:
-        ret = (ret * key + ord(c)) & 0xffffffff
-    return ret
-
-
-def get_string(data):
-    """Get string ending with '\0'.
     
-    Args:
+    def __init__(self, per_entry=False):
+        self.phases = collections.OrderedDict()
+        self.entries = []
+        self.per_entry = per_entry
+        self._lock = threading.Lock()
+    
+    
+    def add(self, phase, seconds, bytes=0, count=1, name=None):
+        """Record a measurement.
+        
+        Args:
+            phase: Phase name.
+            seconds: Time spent.
+            bytes: Bytes processed.
+            count: Number of files or items processed.
+            name: File name, when the measurement is for a single file.
+        
+        Returns:
+            None
+        """
+        with self._lock:
+            total = self.phases.get(phase)
+            if total is None:
+                total = self.phases[phase] = {'seconds': 0.0, 'bytes': 0, 'count': 0}
+            total['seconds'] += seconds
+            total['bytes'] += int(bytes)
+            total['count'] += count
+            if name is not None and self.per_entry:
+                self.entries.append((phase, name, seconds, int(bytes)))
+    
+    
+    def to_dict(self):
+        """Get the recorded phases, and files if recorded, as a JSON serializable dict."""
+        ret = {'phases': self.phases}
+        if self.per_entry:
+            ret['entries'] = [{'phase': phase, 'name': name.decode('latin-1'),
+                               'seconds': seconds, 'bytes': bytes}
+                              for phase, name, seconds, bytes in self.entries]
+        return ret
+    
+    
+    def report(self):
+        """Get a text summary of the recorded phases.
+        
+        Returns:
+            Report text, a line per phase.
+        """
+        lines = ['%-10s %10s %14s %8s %10s'%('Phase', 'Seconds', 'Bytes', 'Count', 'MB/s')]
+        for phase, total in self.phases.items():
+            rate = total['bytes'] / total['seconds'] / 0x100000 if total['seconds'] and total['bytes'] else 0
+            lines.append('%-10s %10.4f %14d %8d %10.1f'%(phase, total['seconds'], total['bytes'],
+                                                        total['count'], rate))
+        if self.per_entry and self.entries:
+            lines.append('Slowest files:')
+            for phase, name, seconds, bytes in sorted(self.entries, key=lambda e: -e[2])[:10]:
+                lines.append('%-10s %10.4f %14d  %s'%(phase, seconds, bytes, name))
+        return '\n'.join(lines)
+
+
+class ArchivePool(object):
+    """Thread-safe LRU cache of open archives.
+    
+    Archives are opened with 'use_mmap' and kept with their parsed FAT, so
+    getting a cached archive costs a single stat. An archive is reopened when
+    the modification time or the size of its file changed. The least recently
+    used archives are closed when there are more than 'max_archives', or their
+    estimated memory use exceeds 'max_memory'. Archives in use are closed only
+    when released. The memory use of an archive is estimated again when it is
+    released, to count the name table built while it was used.
+    
+    Attributes:
+        max_archives: Maximum number of open archives.
+        max_memory: Memory budget in bytes for the cached indexes and for the data
+                    of archives not memory mapped (Yaz0 compressed). None for no budget.
+        hits: Number of requests served from the cache.
+        misses: Number of requests that opened an archive.
+        reloads: Number of archives reopened because their file changed.
+        evictions: Number of archives closed to stay within the limits.
+    """
+    
+    class Item(object):
+        def __init__(self, sarc, key, memory):
+            self.sarc = sarc
+            self.key = key
+            self.memory = memory
+            self.users = 0
+            self.evicted = False
+    
+    
+    def __init__(self, max_archives=64, max_memory=None):
+        self.max_archives = max_archives
+        self.max_memory = max_memory
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._in_use = {}
+        self._memory = 0
+        self._lock = threading.Lock()
+    
+    
+    def acquire(self, path):
+        """Get an open archive from the pool, opening it if needed.
+        
+        Every acquired archive must be given back with 'release'.
+        
+        Args:
+            path: Path to the archive file.
+        
+        Returns:
+            Sarc instance.
+        
+        Raises:
+            OSError: When the archive file doesn't exist.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+        with self._lock:
+            item = self._items.get(path)
+            if item and item.key == key:
+                self.hits += 1
+                ret = self._use(path, item)
+                self._evict()
+                return ret
+            if item:
+                self.reloads += 1
+                self._remove(path)
+            self.misses += 1
+        
+        sarc = Sarc(path=path, use_mmap=True)
+        item = ArchivePool.Item(sarc, key, archive_memory(sarc))
+        with self._lock:
+            other = self._items.get(path)
+            if other and other.key == key:
+                # Another thread opened the same archive meanwhile.
+                sarc.close()
+                return self._use(path, other)
+            if other:
+                self._remove(path)
+            self._items[path] = item
+            self._memory += item.memory
+            ret = self._use(path, item)
+            self._evict()
+            return ret
+    
+    
+    def release(self, sarc):
+        """Give back an archive got with 'acquire'.
+        
+        Args:
+            sarc: Sarc instance.
+        
+        Returns:
+            None
+        """
+        with self._lock:
+            item = self._in_use[id(sarc)]
+            item.users -= 1
+            if not item.users:
+                del self._in_use[id(sarc)]
+                if item.evicted:
+                    item.sarc.close()
+            if not item.evicted:
+                memory = archive_memory(item.sarc)
+                self._memory += memory - item.memory
+                item.memory = memory
+                self._evict()
+    
+    
+    def open(self, path):
+        """Get an archive from the pool for a 'with' statement, which releases it.
+        
+        Args:
+            path: Path to the archive file.
+        
+        Returns:
+            Context manager giving a Sarc instance.
+        """
+        return _PoolArchive(self, path)
+    
+    
+    def clear(self):
+        """Close all the archives not in use and forget all the archives."""
+        with self._lock:
+            for path in list(self._items):
+                self._remove(path)
+    
+    
+    def stats(self):
+        """Get the cache statistics.
+        
+        Returns:
+            Dict of hits, misses, reloads, evictions, number of open archives
+            and their estimated memory use in bytes.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'reloads': self.reloads,
+                    'evictions': self.evictions,
+                    'archives': len(self._items),
+                    'memory': self._memory}
+    
+    
+    def _use(self, path, item):
+        self._items[path] = self._items.pop(path)
+        item.users += 1
+        self._in_use[id(item.sarc)] = item
+        return item.sarc
+    
+    
+    def _remove(self, path):
+        item = self._items.pop(path)
+        self._memory -= item.memory
+        item.evicted = True
+        if not item.users:
+            item.sarc.close()
+    
+    
+    def _evict(self):
+        # Never evict the most recently used archive, the one just acquired.
+        while len(self._items) > 1 and (
+                len(self._items) > self.max_archives or
+                (self.max_memory is not None and self._memory > self.max_memory)):
+            self._remove(next(iter(self._items)))
+            self.evictions += 1
+
+
+class NestedArchives(object):
+    """Resolver of virtual paths into archives nested in archives.
+    
+    A virtual path such as 'Layout.szs/blyt/inner.sarc/timg/foo.bflim' starts
+    with the path of an archive file, followed by the names of archived files,
+    where archived files that are archives themselves can be descended into.
+    Inner archives are parsed from the data of their parent without extracting
+    them; only Yaz0 compressed ones are decompressed into memory. Opened
+    archives are cached, the least recently used are dropped beyond
+    'max_archives', and outer archives are reopened when their files change.
+    
+    Attributes:
+        max_archives: Maximum number of cached archives, outer and inner.
+    """
+    
+    def __init__(self, max_archives=64):
+        self.max_archives = max_archives
+        self._archives = collections.OrderedDict()
+        self._keys = {}
+        self._lock = threading.RLock()
+    
+    
+    def archive(self, path):
+        """Get an archive by its virtual path.
+        
+        Args:
+            path: Path of an archive file, optionally followed by the names of
+                  nested archives.
+        
+        Returns:
+            Sarc instance.
+        
+        Raises:
+            KeyError: When the path doesn't name an archive.
+        """
+        # Resolve and descend in one lock, so the parent isn't dropped meanwhile.
+        with self._lock:
+            sarc, name = self.resolve(path)
+            if name:
+                sarc = self._inner(path, sarc, name)
+            return sarc
+    
+    
+    def open(self, path):
+        """Open an archived file by its virtual path.
+        
+        Args:
+            path: Virtual path of the file.
+        
+        Returns:
+            Read-only, seekable Sarc.EntryFile instance.
+        
+        Raises:
+            KeyError: When the file doesn't exist.
+        """
+        with self._lock:
+            sarc, name = self.resolve(path)
+            if not name:
+                raise KeyError(path)
+            return sarc.open(name)
+    
+    
+    def read(self, path):
+        """Read an archived file by its virtual path."""
+        return self.open(path).read()
+    
+    
+    def resolve(self, path):
+        """Split a virtual path into the innermost archive and a name in it.
+        
+        Args:
+            path: Virtual path.
+        
+        Returns:
+            Sarc instance and the name of the archived file, empty when 'path'
+            is the path of the archive itself.
+        
+        Raises:
+            KeyError: When the path doesn't lead into an archive.
+        """
+        parts = path.replace(os.sep, '/').split('/')
+        for i in range(1, len(parts) + 1):
+            outer = '/'.join(parts[:i])
+            if outer and os.path.isfile(outer):
+                break
+        else:
+            raise KeyError(path)
+        with self._lock:
+            sarc = self._outer(outer)
+            rest = parts[i:]
+            while rest:
+                name = '/'.join(rest)
+                if sarc.find(name):
+                    return sarc, name
+                # Descend into the longest leading name that is an archived archive.
+                for j in range(len(rest) - 1, 0, -1):
+                    name = '/'.join(rest[:j])
+                    entry = sarc.find(name)
+                    if entry and is_archive_data(view(sarc.archive_data, entry.data_start_offset,
+                                                      entry.data_end_offset)):
+                        outer += '/' + name
+                        sarc = self._inner(outer, sarc, name)
+                        rest = rest[j:]
+                        break
+                else:
+                    raise KeyError(path)
+            return sarc, ''
+    
+    
+    def clear(self):
+        """Close and forget all the archives."""
+        with self._lock:
+            for path in list(self._archives):
+                if path in self._archives:
+                    self._drop(path)
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.clear()
+    
+    
+    def _outer(self, path):
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+        if path in self._archives and self._keys[path] != key:
+            # The file changed, drop it and the archives nested in it.
+            self._drop(path)
+        if path not in self._archives:
+            self._add(path, Sarc(path=path, use_mmap=True))
+            self._keys[path] = key
+        return self._get(path)
+    
+    
+    def _inner(self, path, parent, name):
+        if path not in self._archives:
+            entry = parent.find(name)
+            if entry is None:
+                raise KeyError(path)
+            data = view(parent.archive_data, entry.data_start_offset, entry.data_end_offset)
+            if not is_archive_data(data):
+                raise KeyError(path)
+            self._add(path, Sarc(data=data))
+        return self._get(path)
+    
+    
+    def _get(self, path):
+        sarc = self._archives.pop(path)
+        self._archives[path] = sarc
+        return sarc
+    
+    
+    def _add(self, path, sarc):
+        self._archives[path] = sarc
+        # Never drop the new archive or the archives it is nested in.
+        excess = len(self._archives) - self.max_archives
+        for cached in list(self._archives):
+            if excess <= 0:
+                break
+            if cached in self._archives and not (path + '/').startswith(cached + '/'):
+                excess -= 1 + sum(1 for c in self._archives if c.startswith(cached + '/'))
+                self._drop(cached)
+    
+    
+    def _drop(self, path):
+        # Inner archives reference the data of their outer archive, so they are
+        # dropped with it, and the outer archive is closed last.
+        for cached in list(self._archives):
+            if cached.startswith(path + '/'):
+                self._archives.pop(cached)
+        self._archives.pop(path).close()
+        self._keys.pop(path, None)
+
+
+class Catalog(object):
+    """SQLite index of the files in many archives.
+    
+    Answers which archives contain a file name, hash or content digest
+    without opening the archives. Indexing is incremental, archives with an
+    unchanged modification time and size are skipped.
+    
+    Attributes:
+        path: Path to the catalog database.
+    """
+    
+    _SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS archives ('
+        ' id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, mtime REAL, size INTEGER,'
+        ' hash_key INTEGER, error TEXT)',
+        'CREATE TABLE IF NOT EXISTS entries ('
+        ' archive_id INTEGER NOT NULL, hash INTEGER NOT NULL, name TEXT,'
+        ' start INTEGER, end INTEGER, size INTEGER, digest TEXT)',
+        'CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash)',
+        'CREATE INDEX IF NOT EXISTS entries_name ON entries (name)',
+        'CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)',
+        'CREATE INDEX IF NOT EXISTS entries_archive ON entries (archive_id)',
+    ]
+    
+    
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        for statement in self._SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+    
+    
+    def close(self):
+        self._db.close()
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    
+    def index(self, root, patterns=None, jobs=1, verbose=False):
+        """Index the archives in a directory tree.
+        
+        Archives are read with 'jobs' threads and written to the catalog in one
+        transaction. Archives that disappeared from the tree are removed, files
+        that aren't valid archives are recorded so they are skipped too.
+        
+        Args:
+            root: Path to the directory.
+            patterns: File name patterns of the archives. Default 'CATALOG_PATTERNS'.
+            jobs: Number of threads reading archives.
+            verbose: Print verbose information.
+        
+        Returns:
+            Dict of the numbers of 'indexed', 'unchanged', 'removed' and 'failed' archives.
+        """
+        patterns = patterns or CATALOG_PATTERNS
+        root = os.path.abspath(root)
+        known = {path:(id, mtime, size) for id, path, mtime, size in
+                 self._db.execute('SELECT id, path, mtime, size FROM archives')}
+        changed = []
+        seen = set()
+        for path in walk(root):
+            if not any(fnmatch.fnmatch(os.path.basename(path), p) for p in patterns):
+                continue
+            seen.add(path)
+            st = os.stat(path)
+            if known.get(path, (None,))[1:] != (st.st_mtime, st.st_size):
+                changed.append((path, st.st_mtime, st.st_size))
+        removed = [path for path in known
+                   if path.startswith(root + os.sep) and path not in seen]
+        
+        stats = {'indexed': 0, 'unchanged': len(seen) - len(changed),
+                 'removed': len(removed), 'failed': 0}
+        pool = ThreadPool(jobs) if jobs > 1 else None
+        try:
+            scanned = pool.imap(_scan_archive, changed) if pool else (_scan_archive(c) for c in changed)
+            with self._db:
+                for path in removed:
+                    self._remove(known[path][0])
+                    if verbose:
+                        print 'Removed:', path
+                for path, mtime, size, hash_key, rows, error in scanned:
+                    if path in known:
+                        self._remove(known[path][0])
+                    id = self._db.execute('INSERT INTO archives (path, mtime, size, hash_key, error)'
+                                          ' VALUES (?, ?, ?, ?, ?)',
+                                          (path, mtime, size, hash_key, error)).lastrowid
+                    self._db.executemany('INSERT INTO entries VALUES (%d, ?, ?, ?, ?, ?, ?)'%id, rows)
+                    if error:
+                        stats['failed'] += 1
+                    else:
+                        stats['indexed'] += 1
+                    if verbose:
+                        print 'Failed:' if error else 'Indexed:', path
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return stats
+    
+    
+    def _remove(self, id):
+        self._db.execute('DELETE FROM entries WHERE archive_id = ?', (id,))
+        self._db.execute('DELETE FROM archives WHERE id = ?', (id,))
+    
+    
+    def find(self, name):
+        """Find the archives containing a file name.
+        
+        Entries stored without a name match by the hash of 'name'.
+        
+        Args:
+            name: File name relative to the archive root.
+        
+        Returns:
+            List of (archive path, hash, name, start offset, end offset, size, digest) tuples.
+        """
+        ret = self._query('e.name = ?', (name,))
+        for (hash_key,) in self._db.execute('SELECT DISTINCT hash_key FROM archives'
+                                            ' WHERE hash_key IS NOT NULL'):
+            ret += [r[:2] + (name,) + r[3:] for r in
+                    self._query('e.name IS NULL AND e.hash = ? AND a.hash_key = ?',
+                                (calchash(name, hash_key), hash_key))]
+        return ret
+    
+    
+    def find_hash(self, hash):
+        """Find the archives containing a file name hash. Returns like 'find'."""
+        return self._query('e.hash = ?', (hash,))
+    
+    
+    def find_digest(self, digest):
+        """Find the archives containing a file by the SHA-1 digest of its contents. Returns like 'find'."""
+        return self._query('e.digest = ?', (digest,))
+    
+    
+    def _query(self, where, args):
+        return self._db.execute('SELECT a.path, e.hash, e.name, e.start, e.end, e.size, e.digest'
+                                ' FROM entries e JOIN archives a ON a.id = e.archive_id'
+                                ' WHERE ' + where + ' ORDER BY a.path', args).fetchall()
+
+
+def _scan_archive(item):
+    # Read the entries of an archive for 'Catalog.index'. Any error opening or
+    # reading the archive is returned as its error, so one damaged file doesn't
+    # abort indexing the tree.
+    path = item[0]
+    try:
+        sarc = Sarc(path=path, use_mmap=True)
+    except Exception as e:
+        return item + (None, [], str(e) or e.__class__.__name__)
+    try:
+        rows = []
+        for i in range(len(sarc.entries)):
+            e = sarc.entries.entry(i)
+            name = None
+            if e.name_offset & 0xff000000:
+                name = sarc.names.get_name(e.name_offset)
+            data = view(sarc.archive_data, e.data_start_offset, e.data_end_offset)
+            rows.append((e.hash, name, e.data_start_offset, e.data_end_offset,
+                         len(data), hashlib.sha1(data).hexdigest()))
+        return item + (sarc.fatheader.hash_key, rows, None)
+    except Exception as e:
+        return item + (None, [], str(e) or e.__class__.__name__)
+    finally:
+        sarc.close()
+
+
+class _PoolArchive(object):
+    def __init__(self, pool, path):
+        self._pool = pool
+        self._path = path
+        self._sarc = None
+    
+    
+    def __enter__(self):
+        self._sarc = self._pool.acquire(self._path)
+        return self._sarc
+    
+    
+    def __exit__(self, *exc_info):
+        self._pool.release(self._sarc)
+
+
+def archive_memory(sarc):
+    """Estimate the memory used by an open archive.
+    
+    Counts the FAT, the FNT and the parsed name table. The file data is
+    counted only when it was read into memory instead of memory mapped.
+    
+    Args:
+        sarc: Sarc instance.
+    
+    Returns:
+        Size in bytes.
+    """
+    size = len(sarc.entries) * Sarc.FATEntry.C_STRUCTURE_SIZE + len(sarc.fnt_data)
+    if sarc._names is not None:
+        size += len(sarc._names.names) * 0x60
+    if not sarc._mmap:
+        size += len(sarc.archive_data)
+    return size
+
+
+def align(value, alignment):
+    return (value + alignment -1) / alignment * alignment
+
+
+def calchash(data, key):
+    """Calculate file name hash.
+    
+    Args:
+        data: File name data.
+        key: Hash key.
+    
+    Returns:
+        Hash value.
+    """
+    return hash_continue(0, data, key)
+
+
+def hash_continue(value, data, key):
+    """Continue a file name hash over more data.
+    
+    calchash(a + b, key) == hash_continue(calchash(a, key), b, key)
+    
+    Args:
+        value: Hash of the preceding data.
+        data: Data to append.
+        key: Hash key.
+    
+    Returns:
+        Hash value.
+    """
+    ret = value
+    for c in bytearray(data):
+        ret = (ret * key + c) & 0xffffffff
+    return ret
+
+
+def calchash_batch(names, key):
+    """Calculate the hashes of many file names.
+    
+    The hash of every directory prefix is calculated only once and shared by
+    all the names below it. Batches of at least 'NUMPY_HASH_THRESHOLD' names
+    are hashed with NumPy when it is available.
+    
+    Args:
+        names: File names.
+        key: Hash key.
+    
+    Returns:
+        List of hash values in the order of 'names'.
+    """
+    names = list(names)
+    if numpy is not None and len(names) >= NUMPY_HASH_THRESHOLD:
+        return _calchash_numpy(names, key)
+    prefixes = {'': 0}
+    ret = []
+    for name in names:
+        split = name.rfind('/') + 1
+        ret.append(hash_continue(_prefix_hash(name[:split], key, prefixes),
+                                 name[split:], key))
+    return ret
+
+
+def _prefix_hash(prefix, key, cache):
+    ret = cache.get(prefix)
+    if ret is None:
+        split = prefix.rfind('/', 0, len(prefix) - 1) + 1
+        ret = hash_continue(_prefix_hash(prefix[:split], key, cache),
+                            prefix[split:], key)
+        cache[prefix] = ret
+    return ret
+
+
+def _calchash_numpy(names, key):
+    # Names of the same length are hashed together, one character column at a time.
+    ret = [0] * len(names)
+    by_length = {}
+    for i, name in enumerate(names):
+        by_length.setdefault(len(name), []).append(i)
+    key = numpy.uint64(key)
+    mask = numpy.uint64(0xffffffff)
+    for length, indexes in by_length.items():
+        if length == 0:
+            continue
+        chars = numpy.frombuffer(''.join([names[i] for i in indexes]),
+                                 dtype=numpy.uint8).reshape(len(indexes), length)
+        values = numpy.zeros(len(indexes), dtype=numpy.uint64)
+        for column in range(length):
+            values = (values * key + chars[:, column]) & mask
+        for i, value in zip(indexes, values.tolist()):
+            ret[i] = value
+    return ret
+
+
+def recover_names(hashes, key, words, templates=None):
+    """Recover file names from their hashes by hashing candidate names.
+    
+    Candidates are built by substituting every word for '{}' in every template.
+    Each word is hashed once, and its hash is combined with the hashes of the
+    template's prefix and suffix, with NumPy when it is available.
+    
+    Args:
+        hashes: Hashes to recover names for.
+        key: Hash key.
+        words: Candidate words.
+        templates: Name templates such as 'timg/{}.bflim'. Default the words themselves.
+    
+    Returns:
+        Dict of recovered hash to file name.
+    """
+    targets = set(int(h) for h in hashes)
+    words = list(words)
+    word_hashes = calchash_batch(words, key)
+    powers = {}
+    for word in words:
+        if len(word) not in powers:
+            powers[len(word)] = pow(key, len(word), 1 << 32)
+    word_powers = [powers[len(word)] for word in words]
+    if numpy is not None:
+        word_hashes = numpy.array(word_hashes, dtype=numpy.uint64)
+        word_powers = numpy.array(word_powers, dtype=numpy.uint64)
+        target_array = numpy.array(sorted(targets), dtype=numpy.uint64)
+        mask = numpy.uint64(0xffffffff)
+    
+    found = {}
+    for template in templates or ['{}']:
+        if '{}' not in template:
+            hash = calchash(template, key)
+            if hash in targets:
+                found.setdefault(hash, template)
+            continue
+        prefix, suffix = template.split('{}', 1)
+        prefix_hash = calchash(prefix, key)
+        suffix_hash = calchash(suffix, key)
+        suffix_power = pow(key, len(suffix), 1 << 32)
+        if numpy is not None:
+            values = (word_hashes + word_powers * numpy.uint64(prefix_hash)) & mask
+            values = (values * numpy.uint64(suffix_power) + numpy.uint64(suffix_hash)) & mask
+            matched = numpy.nonzero(numpy.in1d(values, target_array))[0].tolist()
+        else:
+            values = [((prefix_hash * p + h) * suffix_power + suffix_hash) & 0xffffffff
+                      for h, p in zip(word_hashes, word_powers)]
+            matched = [i for i, v in enumerate(values) if v in targets]
+        for i in matched:
+            found.setdefault(int(values[i]), prefix + words[i] + suffix)
+    return found
+
+
+def load_name_map(path):
+    """Load a hash to file name mapping file.
+    
+    Each line has the format printed when listing an archive:
+    'Hash: 0123ABCD  Path: Name/Of/File'
+    
+    Args:
+        path: Path to the mapping file.
+    
+    Returns:
+        Dict of hash to file name.
+    """
+    name_map = {}
+    for line in open(path, 'r'):
+        line = line.rstrip('\r\n')
+        if not line.startswith('Hash: ') or '  Path: ' not in line:
+            continue
+        hash, name = line[len('Hash: '):].split('  Path: ', 1)
+        name_map[int(hash, 16)] = name
+    return name_map
+
+
+def save_name_map(path, name_map):
+    """Save a hash to file name mapping file readable by 'load_name_map'.
+    
+    Args:
+        path: Path to the mapping file.
+        name_map: Dict of hash to file name.
+    
+    Returns:
+        None
+    """
+    fs = open(path, 'w')
+    for hash in sorted(name_map):
+        fs.write('Hash: %08X  Path: %s\n'%(hash, name_map[hash]))
+    fs.close()
+
+
+def read_wordlist(path):
+    """Read candidate words, one per line, skipping empty lines."""
+    return [line.strip() for line in open(path, 'r') if line.strip()]
+
+
+def copy_stream(src, dst, size=-1, digest=None):
+    """Copy data between file objects in chunks of 'COPY_CHUNK_SIZE'.
+    
+    Args:
+        src: Input file object.
+        dst: Output file object.
+        size: Number of bytes to copy. Default until the end of 'src'.
+        digest: hashlib object to update with the copied data.
+    
+    Returns:
+        Number of bytes copied.
+    """
+    copied = 0
+    while size < 0 or copied < size:
+        chunk_size = COPY_CHUNK_SIZE if size < 0 else min(COPY_CHUNK_SIZE, size - copied)
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        if digest:
+            digest.update(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def _load_copy_range():
+    # Find a way to copy between file descriptors within the kernel: the os module
+    # functions of newer Pythons, or sendfile from the C library on Linux.
+    if hasattr(os, 'copy_file_range'):
+        return lambda src, dst, offset, size: os.copy_file_range(src, dst, size, offset)
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        return lambda src, dst, offset, size: os.sendfile(dst, src, offset, size)
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    
+    def copy(src, dst, offset, size):
+        ret = sendfile(dst, src, ctypes.byref(ctypes.c_int64(offset)), size)
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ret
+    return copy
+
+_copy_range = _load_copy_range()
+_COPY_RANGE_UNSUPPORTED = set(getattr(errno, e) for e in
+                              ('ENOSYS', 'EINVAL', 'EXDEV', 'EOPNOTSUPP', 'ENOTSUP')
+                              if hasattr(errno, e))
+
+
+def copy_range(src_fd, dst_fd, offset, size):
+    """Copy a range of a file to the current position of another file within the kernel.
+    
+    The data doesn't pass through Python memory, and the position of 'src_fd'
+    isn't changed, so threads can share it. Stops early when the platform or
+    the file systems don't support it.
+    
+    Args:
+        src_fd: Input file descriptor.
+        dst_fd: Output file descriptor.
+        offset: Offset of the range in the input file.
+        size: Size of the range.
+    
+    Returns:
+        Number of bytes copied.
+    """
+    global _copy_range
+    copied = 0
+    while _copy_range and copied < size:
+        try:
+            ret = _copy_range(src_fd, dst_fd, offset + copied, min(size - copied, 0x40000000))
+        except OSError as e:
+            if e.errno not in _COPY_RANGE_UNSUPPORTED:
+                raise
+            if not copied:
+                _copy_range = None
+            break
+        if not ret:
+            break
+        copied += ret
+    return copied
+
+
+def is_archive_data(data):
+    """Check if data is an archive, SARC or Yaz0 compressed, by its signature."""
+    signature = data[:4]
+    return (signature == YAZ0_SIGNATURE or
+            signature == Sarc.ArchiveBlockHeader.C_SIGNATURE)
+
+
+def is_yaz0(path):
+    """Check if a file is Yaz0 compressed by its signature."""
+    fs = open(path, 'rb')
+    signature = fs.read(len(YAZ0_SIGNATURE))
+    fs.close()
+    return signature == YAZ0_SIGNATURE
+
+
+def yaz0_decompress(src, dst):
+    """Decompress Yaz0 data from one file object to another.
+    
+    The input is read in chunks of 'COPY_CHUNK_SIZE', and only the last 0x1000
+    bytes of output are kept in memory for back references.
+    
+    Args:
+        src: Input file object positioned at the Yaz0 header.
+        dst: Output file object.
+    
+    Returns:
+        Decompressed size.
+    
+    Raises:
+        ValueError: When the input isn't Yaz0 compressed, or is truncated or corrupt.
+    """
+    header = src.read(YAZ0_HEADER_SIZE)
+    if header[:4] != YAZ0_SIGNATURE:
+        raise ValueError('Invalid Yaz0 signature')
+    if len(header) < YAZ0_HEADER_SIZE:
+        raise ValueError('Truncated Yaz0 data')
+    size = unpack('>I', header[4:8])[0]
+    data = bytearray()
+    pos = 0
+    out = bytearray()
+    flushed = 0
+    try:
+        while flushed + len(out) < size:
+            if len(data) - pos < 25:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk and pos >= len(data):
+                    raise ValueError('Truncated Yaz0 data')
+                data = data[pos:] + bytearray(chunk)
+                pos = 0
+            code = data[pos]
+            pos += 1
+            if code == 0xff and flushed + len(out) + 8 <= size and pos + 8 <= len(data):
+                out += data[pos:pos + 8]
+                pos += 8
+                continue
+            for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if code & bit:
+                    out.append(data[pos])
+                    pos += 1
+                else:
+                    dist = ((data[pos] & 0x0f) << 8 | data[pos + 1]) + 1
+                    count = data[pos] >> 4
+                    if count:
+                        count += 2
+                        pos += 2
+                    else:
+                        count = data[pos + 2] + 0x12
+                        pos += 3
+                    start = len(out) - dist
+                    if start < 0:
+                        raise ValueError('Invalid Yaz0 back reference')
+                    if dist >= count:
+                        out += out[start:start + count]
+                    else:
+                        out += (out[start:] * (count // dist + 1))[:count]
+                if flushed + len(out) >= size:
+                    break
+            if len(out) >= COPY_CHUNK_SIZE:
+                dst.write(out[:-_YAZ0_WINDOW])
+                flushed += len(out) - _YAZ0_WINDOW
+                del out[:-_YAZ0_WINDOW]
+    except IndexError:
+        # The input ran out in the middle of a group.
+        raise ValueError('Truncated Yaz0 data')
+    dst.write(out[:size - flushed])
+    return size
+
+
+def yaz0_compress(data, level=YAZ0_DEFAULT_LEVEL):
+    """Compress data with Yaz0.
+    
+    Matches are found with hash chains over the 0x1000 byte window. Level 0
+    only stores literals, higher levels follow longer chains, levels from 4
+    index every position inside matches and levels from 6 use lazy matching.
+    Levels up to 3 search less often inside long runs of literals.
+    
+    Args:
+        data: Data to compress.
+        level: Compression level from 0 (fastest) to 9 (smallest).
+    
+    Returns:
+        Compressed data.
+    
+    Raises:
+        ValueError: When the level is out of range.
+    """
+    if level not in range(len(YAZ0_LEVELS)):
+        raise ValueError('Invalid Yaz0 level: %r'%(level,))
+    size = len(data)
+    header = YAZ0_SIGNATURE + pack('>III', size, 0, 0)
+    if level == 0:
+        return ''.join([header] + ['\xff' + data[i:i + 8] for i in range(0, size, 8)])
+    chain_depth, nice_length = YAZ0_LEVELS[level]
+    lazy = level >= 6
+    insert_all = level >= 4
+    accelerate = level <= 3
+    out = bytearray(header)
+    head = {}
+    prev = [-1] * _YAZ0_WINDOW
+    
+    def find(pos):
+        # Insert 'pos' into the hash chains and return its longest match.
+        limit = min(_YAZ0_MAX_MATCH, size - pos)
+        if limit < _YAZ0_MIN_MATCH:
+            return 0, 0
+        key = data[pos:pos + 3]
+        cand = head.get(key, -1)
+        head[key] = pos
+        prev[pos & 0xfff] = cand
+        best_length = 0
+        best_dist = 0
+        depth = chain_depth
+        while cand >= 0 and pos - cand <= _YAZ0_WINDOW and depth:
+            if data[cand + best_length] == data[pos + best_length]:
+                length = _match_length(data, cand, pos, limit)
+                if length > best_length:
+                    best_length = length
+                    best_dist = pos - cand
+                    if length >= nice_length or length == limit:
+                        break
+            depth -= 1
+            next_cand = prev[cand & 0xfff]
+            if next_cand >= cand:
+                break
+            cand = next_cand
+        return best_length, best_dist
+    
+    def insert(pos):
+        key = data[pos:pos + 3]
+        prev[pos & 0xfff] = head.get(key, -1)
+        head[key] = pos
+    
+    pos = 0
+    bit = 0
+    code_pos = 0
+    pending = None
+    literals = 0
+    skip = 0
+    while pos < size:
+        if bit == 0:
+            code_pos = len(out)
+            out.append(0)
+            bit = 0x80
+        if pending:
+            length, dist = pending
+            pending = None
+        elif skip:
+            skip -= 1
+            length = -1
+        else:
+            length, dist = find(pos)
+        inserted = pos + 1
+        if lazy and _YAZ0_MIN_MATCH <= length < nice_length:
+            next_length, next_dist = find(pos + 1)
+            inserted = pos + 2
+            if next_length > length:
+                pending = (next_length, next_dist)
+                length = 0
+        if length >= _YAZ0_MIN_MATCH:
+            dist -= 1
+            if length >= 0x12:
+                out.extend((dist >> 8, dist & 0xff, length - 0x12))
+            else:
+                out.extend(((length - 2) << 4 | dist >> 8, dist & 0xff))
+            if insert_all:
+                for p in range(inserted, min(pos + length, size - 2)):
+                    insert(p)
+            pos += length
+            literals = 0
+        else:
+            out[code_pos] |= bit
+            out.append(data[pos])
+            pos += 1
+            literals += 1
+            if accelerate and length == 0:
+                skip = min(literals >> 6, 0x1f)
+        bit >>= 1
+    return str(out)
+
+
+def _match_length(data, a, b, limit):
+    # Length of the common prefix of data[a:] and data[b:], up to 'limit'.
+    if data[a:a + limit] == data[b:b + limit]:
+        return limit
+    lo, hi = 0, limit
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if data[a:a + mid] == data[b:b + mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def file_digest(path, offset=0, size=-1):
+    """Calculate the SHA-1 digest of a file's contents, or 'size' bytes from 'offset'."""
+    fs = open(path, 'rb')
+    fs.seek(offset)
+    digest = stream_digest(fs, size)
+    fs.close()
+    return digest
+
+
+def stream_digest(fs, size=-1):
+    """Calculate the SHA-1 digest of 'size' bytes read from a file object, default until its end."""
+    digest = hashlib.sha1()
+    while size:
+        chunk = fs.read(COPY_CHUNK_SIZE if size < 0 else min(COPY_CHUNK_SIZE, size))
+        if not chunk:
+            break
+        digest.update(chunk)
+        size -= len(chunk)
+    return digest.hexdigest()
+
+
+def get_string(data):
+    """Get string ending with '\0'.
+    
+    Args:
         data: Data containing string.
     
     Returns:
         String without '\0'.
     """
-    ret = ''
-    for c in data:
-        if '\x00' == c:
+    ret = []
+    pos = 0
+    while True:
+        chunk = data[pos:pos + 0x40]
+        end = chunk.find('\x00')
+        if end >= 0:
+            ret.append(chunk[:end])
             break
-        ret += c
-    return ret
+        ret.append(chunk)
+        if len(chunk) < 0x40:
+            break
+        pos += len(chunk)
+    return ''.join(ret)
 
 
 def getrpath(base, full):
@@ -586,7 +3312,7 @@ def getrpath(base, full):
 
     
 def mkdirs(path):
-    if not os.path.exists(path):
+    if path and not os.path.exists(path):
         os.makedirs(path)
 
 
@@ -599,6 +3325,22 @@ def walk(dirname):
     return filelist
 
 
+def view(data, start=0, end=None):
+    """Get a zero-copy view of a slice of data.
+    
+    Args:
+        data: str, buffer or mmap object.
+        start: Slice start.
+        end: Slice end. Default the end of data.
+    
+    Returns:
+        Read-only buffer referencing data.
+    """
+    if end is None:
+        end = len(data)
+    return buffer(data, start, end - start)
+
+
 def write_file(path, data):
     fs = open(path, 'wb')
     fs.write(data)
@@ -606,7 +3348,8 @@ def write_file(path, data):
 
 
 #Helper methods
-def create_archive(path, archive, order, hash_key, verbose, exclude):
+def create_archive(path, archive, order, hash_key, verbose, exclude, dry_run=False, jobs=1, cache=False,
+                   yaz0_level=None, dedup=False, stats=None):
     """Create an archive from the input directory.
     
     Args:
@@ -615,6 +3358,13 @@ def create_archive(path, archive, order, hash_key, verbose, exclude):
         order: Byte order of the archive. Must be '>' or '<'.
         hash_key: File name hash key. Default 0x65.
         verbose: Enable verbose output.
+        dry_run: Only print the size of the archive instead of writing it.
+        jobs: Number of threads reading file metadata, and file contents ahead of writing them.
+        cache: Reuse unchanged file data from the previous build of the archive.
+        yaz0_level: Yaz0 compression level. Default level 3 if the archive name ends
+                    with '.szs', otherwise no compression.
+        dedup: Store files with identical contents once.
+        stats: Stats instance recording the time spent in each phase.
     
     Returns:
         Boolean
@@ -622,17 +3372,25 @@ def create_archive(path, archive, order, hash_key, verbose, exclude):
     if (not path) or (not os.path.exists(path)):
         print 'Directory does not exist. Create archive failed.'
         return False
-    sarc = Sarc(path=path, order=order, hash_key=hash_key, exclude=exclude)
-    sarc.archive(archive_path=archive, verbose=verbose)
+    if yaz0_level is None and archive.lower().endswith('.szs'):
+        yaz0_level = YAZ0_DEFAULT_LEVEL
+    sarc = Sarc(path=path, order=order, hash_key=hash_key, exclude=exclude, jobs=jobs, stats=stats)
+    if dry_run:
+        print 'Archive size: %d'%sarc.archive_size(dedup)
+    else:
+        sarc.archive(archive_path=archive, verbose=verbose, cache=cache, yaz0_level=yaz0_level, dedup=dedup)
 
 
-def extract_archive(path, archive, verbose):
+def extract_archive(path, archive, verbose, jobs=1, names=None, stats=None):
     """Extract an archive to the specified directory.
     
     Args:
         path: Path to output directory.
-        archive: Path to the archive.
+        archive: Path to the archive, or virtual path of an archive nested in archives.
         verbose: Enable verbose output.
+        jobs: Number of threads writing files.
+        names: Path to a mapping file naming the entries stored without a name.
+        stats: Stats instance recording the time spent in each phase.
     
     Returns:
         Boolean
@@ -640,21 +3398,492 @@ def extract_archive(path, archive, verbose):
     if not path:
         print "Output directory hasn't set. Extract archive failed."
         return False
-    sarc = Sarc(path=archive)
-    sarc.extract(path=path, all=True, verbose=verbose)
+    with NestedArchives() as archives:
+        if stats:
+            start = time.time()
+        try:
+            sarc = archives.archive(archive)
+        except KeyError:
+            print 'Archive does not exist. Extract archive failed.'
+            return False
+        except ValueError as e:
+            print '%s. Extract archive failed.'%e
+            return False
+        if stats:
+            stats.add('open', time.time() - start)
+            sarc.stats = stats
+        if names:
+            sarc.name_map = load_name_map(names)
+        sarc.extract(path=path, all=True, verbose=verbose, jobs=jobs)
+    return True
 
 
-def list_archive(archive):
+def list_archive(archive, names=None):
     """List contents in the archive.
     
     Args:
-        archive: Path to the archive.
+        archive: Path to the archive, or virtual path of an archive nested in archives.
+        names: Path to a mapping file naming the entries stored without a name.
     
     Returns:
         None
     """
-    sarc = Sarc(path=archive)
-    sarc.extract(path='', all=True, save_file=False)
+    with NestedArchives() as archives:
+        try:
+            sarc = archives.archive(archive)
+        except KeyError:
+            print 'Archive does not exist. List archive failed.'
+            return
+        except ValueError as e:
+            print '%s. List archive failed.'%e
+            return
+        if names:
+            sarc.name_map = load_name_map(names)
+        sarc.extract(path='', all=True, save_file=False)
+
+def update_archive(path, archive, files=None, remove=None, verbose=False):
+    """Add, replace or remove entries of an archive in place.
+    
+    Args:
+        path: Path to the directory the files are named relative to. Required to add files.
+        archive: Path to the archive.
+        files: Paths to the files to add or replace, inside 'path'. Default all files in 'path'.
+        remove: Names of the entries to remove.
+        verbose: Enable verbose output.
+    
+    Returns:
+        Boolean
+    """
+    if not os.path.isfile(archive):
+        print 'Archive does not exist. Update archive failed.'
+        return False
+    if files and not path:
+        print "Working directory hasn't set. Update archive failed."
+        return False
+    if files is None:
+        files = walk(path) if path else []
+    names = {}
+    for f in files:
+        try:
+            name = os.path.relpath(f, path).replace(os.sep, '/')
+        except ValueError:
+            name = '..'
+        if name == '..' or name.startswith('../'):
+            print 'File is not in the working directory: %s. Update archive failed.'%f
+            return False
+        names[name] = f
+    try:
+        sarc = Sarc(path=archive, use_mmap=True)
+    except ValueError as e:
+        print '%s. Update archive failed.'%e
+        return False
+    try:
+        sarc.update(names, remove, verbose)
+    except KeyError as e:
+        print 'Entry does not exist: %s. Update archive failed.'%e.args[0]
+        return False
+    except ValueError as e:
+        print '%s Update archive failed.'%e
+        return False
+    finally:
+        sarc.close()
+    return True
+
+
+def recover_archive_names(archive, wordlists, templates, names=None):
+    """Recover entry names of the archive from wordlists and print the matches.
+    
+    Args:
+        archive: Path to the archive.
+        wordlists: Paths to files with one candidate word per line.
+        templates: Name templates such as 'timg/{}.bflim'.
+        names: Path to write the recovered names to as a mapping file.
+    
+    Returns:
+        Dict of recovered hash to file name.
+    """
+    if not os.path.isfile(archive):
+        print 'Archive does not exist. Recover names failed.'
+        return {}
+    try:
+        sarc = Sarc(path=archive, use_mmap=True)
+    except ValueError as e:
+        print '%s. Recover names failed.'%e
+        return {}
+    words = []
+    for wordlist in wordlists or []:
+        words.extend(read_wordlist(wordlist))
+    found = sarc.recover_names(words, templates)
+    for hash in sorted(found):
+        print 'Hash: %08X  Path: %s'%(hash, found[hash])
+    print 'Recovered %d of %d hashes.'%(len(found), len(sarc.entries))
+    sarc.close()
+    if names:
+        save_name_map(names, found)
+    return found
+
+def archive_to_tar(archive, tar, verbose=False):
+    """Convert an archive to a tar archive without extracting it.
+    
+    Args:
+        archive: Path to the archive, or virtual path of an archive nested in archives.
+        tar: Path to the tar archive, or '-' for standard output.
+        verbose: Enable verbose output, to standard error.
+    
+    Returns:
+        Boolean
+    """
+    with NestedArchives() as archives:
+        try:
+            sarc = archives.archive(archive)
+        except KeyError:
+            print >> sys.stderr, 'Archive does not exist. Convert archive failed.'
+            return False
+        except ValueError as e:
+            print >> sys.stderr, '%s. Convert archive failed.'%e
+            return False
+        fs = sys.stdout if tar == '-' else open(tar, 'wb')
+        sarc.to_tar(fs, verbose)
+        if fs is not sys.stdout:
+            fs.close()
+    return True
+
+
+def tar_to_archive(tar, archive, order, hash_key, verbose, exclude, yaz0_level=None, dedup=False, stats=None):
+    """Create an archive from the files in a tar archive without extracting them.
+    
+    Args:
+        tar: Path to the tar archive, optionally compressed, or '-' for standard input.
+        archive: Path to the archive.
+        order: Byte order of the archive. Must be '>' or '<'.
+        hash_key: File name hash key. Default 0x65.
+        verbose: Enable verbose output.
+        exclude: Patterns of file names to leave out.
+        yaz0_level: Yaz0 compression level. Default level 3 if the archive name ends
+                    with '.szs', otherwise no compression.
+        dedup: Store files with identical contents once.
+        stats: Stats instance recording the time spent in each phase.
+    
+    Returns:
+        Boolean
+    """
+    if tar != '-' and not os.path.isfile(tar):
+        print 'Tar archive does not exist. Create archive failed.'
+        return False
+    if yaz0_level is None and archive.lower().endswith('.szs'):
+        yaz0_level = YAZ0_DEFAULT_LEVEL
+    sarc = Sarc(order=order, hash_key=hash_key, exclude=exclude, stats=stats)
+    try:
+        if not sarc.add_tar(sys.stdin if tar == '-' else open(tar, 'rb'), close=tar != '-'):
+            print 'Tar archive has no files. Create archive failed.'
+            return False
+        sarc.archive(archive_path=archive, verbose=verbose, yaz0_level=yaz0_level, dedup=dedup)
+    finally:
+        sarc.close()
+    return True
+
+
+def merge_archives(sources, archive, on_conflict='error', verbose=False, yaz0_level=None, dedup=False, stats=None):
+    """Merge archives into a new archive without extracting them.
+    
+    The archive gets the byte order and hash key of the first source.
+    
+    Args:
+        sources: Paths to the archives to merge.
+        archive: Path to the merged archive.
+        on_conflict: 'error' to fail on conflicting entries, 'first' to keep the entry
+                     of the earliest source, or 'last' to keep the latest.
+        verbose: Enable verbose output.
+        yaz0_level: Yaz0 compression level. Default level 3 if the archive name ends
+                    with '.szs', otherwise no compression.
+        dedup: Store files with identical contents once.
+        stats: Stats instance recording the time spent in each phase.
+    
+    Returns:
+        Boolean
+    """
+    for path in sources:
+        if not os.path.isfile(path):
+            print 'Archive does not exist: %s. Merge archives failed.'%path
+            return False
+    if yaz0_level is None and archive.lower().endswith('.szs'):
+        yaz0_level = YAZ0_DEFAULT_LEVEL
+    opened = []
+    for path in sources:
+        try:
+            opened.append(Sarc(path=path, use_mmap=True))
+        except ValueError as e:
+            print '%s: %s. Merge archives failed.'%(path, e)
+            for source in opened:
+                source.close()
+            return False
+    sarc = Sarc(order=opened[0].header.order, hash_key=opened[0].fatheader.hash_key, stats=stats)
+    try:
+        for path, source in zip(sources, opened):
+            for name, kind in sarc.add_archive(source, on_conflict=on_conflict):
+                print 'Conflict (%s): %s in %s'%(kind, name, path)
+        sarc.archive(archive_path=archive, verbose=verbose, yaz0_level=yaz0_level, dedup=dedup)
+    except ValueError as e:
+        print '%s. Merge archives failed.'%e
+        return False
+    finally:
+        sarc.close()
+        for source in opened:
+            source.close()
+    return True
+
+
+def split_archive(path, archive, pattern, max_entries=None, order='<', hash_key=DEFAULT_HASH_KEY,
+                  verbose=False, exclude=None, yaz0_level=None, stats=None):
+    """Split an archive, or the files in a directory, into archives of limited entry counts.
+    
+    Args:
+        path: Directory of the files to split, instead of an archive.
+        archive: Path to the archive to split, when 'path' is not set.
+        pattern: Path of the parts, '{}' is replaced by the part number. Default
+                 '_{}' before the extension.
+        max_entries: Maximum number of entries per part.
+                     Default 'FATBlockHeader._C_ARCHIVE_ENTRY_MAX'.
+        order: Byte order of the parts split from a directory. Must be '>' or '<'.
+        hash_key: Hash key of the parts split from a directory. Default 0x65.
+        verbose: Enable verbose output.
+        exclude: Patterns of file names to leave out of a directory.
+        yaz0_level: Yaz0 compression level. Default level 3 if the part names end
+                    with '.szs', otherwise no compression.
+        stats: Stats instance recording the time spent in each phase.
+    
+    Returns:
+        Boolean
+    """
+    if path:
+        if not os.path.isdir(path):
+            print 'Directory does not exist. Split archive failed.'
+            return False
+        sarc = Sarc(path=path, order=order, hash_key=hash_key, exclude=exclude, stats=stats)
+    elif os.path.isfile(archive):
+        try:
+            sarc = Sarc(path=archive, use_mmap=True)
+        except ValueError as e:
+            print '%s. Split archive failed.'%e
+            return False
+        sarc.stats = stats
+    else:
+        print 'Archive does not exist. Split archive failed.'
+        return False
+    if '{}' not in pattern:
+        root, ext = os.path.splitext(pattern)
+        pattern = root + '_{}' + ext
+    if yaz0_level is None and pattern.lower().endswith('.szs'):
+        yaz0_level = YAZ0_DEFAULT_LEVEL
+    try:
+        for i, part in enumerate(sarc.split(max_entries)):
+            part_path = pattern.format(i)
+            part.archive(archive_path=part_path, verbose=verbose, yaz0_level=yaz0_level)
+            part.close()
+            if verbose:
+                print 'Split: %s (%d entries)'%(part_path, part.fatheader.file_count)
+    finally:
+        sarc.close()
+    return True
+
+
+def diff_archives(old, new, jobs=1):
+    """Print the differences between two archives as JSON without extracting them.
+    
+    Args:
+        old: Path to the old archive, or virtual path of an archive nested in archives.
+        new: Path to the new archive, or virtual path of an archive nested in archives.
+        jobs: Number of threads digesting large members.
+    
+    Returns:
+        True if the archives differ, False if not, None if comparing failed.
+    """
+    with NestedArchives() as archives:
+        try:
+            old_sarc = archives.archive(old)
+            new_sarc = archives.archive(new)
+        except KeyError:
+            print >> sys.stderr, 'Archive does not exist. Diff archives failed.'
+            return None
+        except ValueError as e:
+            print >> sys.stderr, '%s. Diff archives failed.'%e
+            return None
+        try:
+            report = old_sarc.diff(new_sarc, jobs)
+        except ValueError as e:
+            print >> sys.stderr, '%s. Diff archives failed.'%e
+            return None
+    for kind in ('added', 'removed', 'changed'):
+        for e in report[kind]:
+            e['name'] = e['name'].decode('latin-1')
+            e['hash'] = '%08X'%e['hash']
+    report.update({'old': old, 'new': new})
+    print json.dumps(report, indent=1, sort_keys=True)
+    return bool(report['added'] or report['removed'] or report['changed'])
+
+
+def index_catalog(path, catalog, jobs=1, verbose=False):
+    """Index the archives in a directory tree into a catalog.
+    
+    Args:
+        path: Path to the directory.
+        catalog: Path to the catalog database.
+        jobs: Number of threads reading archives.
+        verbose: Enable verbose output.
+    
+    Returns:
+        Boolean
+    """
+    if (not path) or (not os.path.isdir(path)):
+        print 'Directory does not exist. Index archives failed.'
+        return False
+    with Catalog(catalog) as c:
+        stats = c.index(path, jobs=jobs, verbose=verbose)
+    print 'Indexed %(indexed)d, unchanged %(unchanged)d, removed %(removed)d, failed %(failed)d archives.'%stats
+    return True
+
+
+def search_catalog(catalog, queries):
+    """Print the archives containing files by name, or by hash given as '0x' hex.
+    
+    Args:
+        catalog: Path to the catalog database.
+        queries: File names or hashes.
+    
+    Returns:
+        Number of files found.
+    """
+    found = 0
+    with Catalog(catalog) as c:
+        for query in queries:
+            if query.lower().startswith('0x'):
+                rows = c.find_hash(int(query, 16))
+            else:
+                rows = c.find(query)
+            for path, hash, name, start, end, size, digest in rows:
+                print 'Archive: %s  Hash: %08X  Path: %s'%(path, hash, name or UNNAMED_FORMAT%hash)
+            found += len(rows)
+    return found
+
+def expand_batch(specs):
+    """Expand batch inputs into a list of archives or directories.
+    
+    Args:
+        specs: Paths, glob patterns, or '@' followed by the path of a manifest file
+               listing one input per line. A manifest line may give the output,
+               the extract directory or the created archive, after a tab.
+    
+    Returns:
+        List of (input, output) tuples, output None when not given.
+    """
+    ret = []
+    for spec in specs:
+        if spec.startswith('@'):
+            for line in open(spec[1:], 'r'):
+                line = line.rstrip('\r\n')
+                if line.strip() and not line.startswith('#'):
+                    fields = line.split('\t')
+                    ret.append((fields[0], fields[1] if len(fields) > 1 else None))
+        else:
+            ret.extend((p, None) for p in sorted(glob.glob(spec)) or [spec])
+    return ret
+
+
+def batch_output_path(path, archive):
+    """Get the directory an archive is extracted to in batch mode: the archive
+    path without its extension, below 'path'."""
+    parts = [p for p in os.path.splitext(archive)[0].replace('\\', '/').split('/')
+             if p not in ('', '.', '..')]
+    return os.path.join(path or '', *parts)
+
+
+def batch_archives(mode, specs, path=None, jobs=1, verbose=False, **options):
+    """Extract, list or create many archives with a pool of processes.
+    
+    A JSON line is printed for every archive as it completes. Failures don't
+    stop the batch, they are collected and returned.
+    
+    Args:
+        mode: 'extract', 'list' or 'create'.
+        specs: Archives to extract or list, or directories to create archives
+               from, as paths, glob patterns or '@' manifest files.
+        path: Directory archives are extracted to, each in 'batch_output_path'.
+        jobs: Number of processes.
+        verbose: Print a line for every archive to standard error.
+        options: 'order', 'hash_key', 'exclude', 'cache', 'yaz0_level' and
+                 'dedup' for creating, 'names' for extracting and listing.
+    
+    Returns:
+        List of the results of the failed archives.
+    """
+    tasks = []
+    for source, target in expand_batch(specs):
+        if mode == 'extract' and target is None:
+            target = batch_output_path(path, source)
+        elif mode == 'create' and target is None:
+            target = source.rstrip('/\\') + ('.sarc' if options.get('yaz0_level') is None else '.szs')
+        tasks.append((mode, source, target, options))
+    
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    failed = []
+    try:
+        results = pool.imap_unordered(_batch_job, tasks) if pool else (_batch_job(t) for t in tasks)
+        for result in results:
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+            if not result['ok']:
+                failed.append(result)
+            if verbose:
+                print >> sys.stderr, '%s: %s'%('Done' if result['ok'] else 'Failed', result['input'])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    print >> sys.stderr, 'Processed %d, failed %d.'%(len(tasks), len(failed))
+    return failed
+
+
+def _batch_job(task):
+    # Run a single 'batch_archives' task. Any error is reported in the result.
+    mode, source, target, options = task
+    result = {'mode': mode, 'input': source, 'output': target}
+    start = time.time()
+    try:
+        if mode == 'create':
+            if not os.path.isdir(source):
+                raise IOError(errno.ENOENT, 'Directory does not exist', source)
+            yaz0_level = options.get('yaz0_level')
+            if yaz0_level is None and target.lower().endswith('.szs'):
+                yaz0_level = YAZ0_DEFAULT_LEVEL
+            sarc = Sarc(path=source, order=options.get('order', '<'),
+                        hash_key=options.get('hash_key', DEFAULT_HASH_KEY),
+                        exclude=options.get('exclude'))
+            sarc.archive(target, cache=options.get('cache', False),
+                         yaz0_level=yaz0_level, dedup=options.get('dedup', False))
+            result['files'] = len(sarc.entries or {})
+            result['size'] = os.path.getsize(target)
+        else:
+            with NestedArchives() as archives:
+                sarc = archives.archive(source)
+                if options.get('names'):
+                    sarc.name_map = load_name_map(options['names'])
+                if mode == 'extract':
+                    sarc.extract(path=target, all=True)
+                    result['files'] = len(sarc.entries)
+                else:
+                    sarc.names
+                    table = sarc.entries
+                    result['entries'] = [{'hash': int(table.hashes[i]),
+                                          'name': sarc._get_name(int(table.hashes[i]),
+                                                                 table.name_offsets[i]).decode('latin-1'),
+                                          'size': int(table.end_offsets[i] - table.start_offsets[i])}
+                                         for i in table.sorted_indexes()]
+        result['ok'] = True
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = '%s: %s'%(e.__class__.__name__, e)
+    result['seconds'] = round(time.time() - start, 6)
+    return result
 
 if '__main__' == __name__:
     endianess = {'big':'>', 'little':'<'}
@@ -664,17 +3893,83 @@ if '__main__' == __name__:
     group.add_argument('-x', '--extract', help='Extract the archive', action='store_true', default=False)
     group.add_argument('-c', '--create', help='Create an archive', action='store_true',default=False)
     group.add_argument('-l', '--list', help='List contents of the archive', action='store_true', default=False)
+    group.add_argument('-u', '--update', help='Add, replace or remove entries of the archive', action='store_true', default=False)
+    group.add_argument('-r', '--recover', help='Recover entry names from wordlists', action='store_true', default=False)
+    group.add_argument('--to-tar', help="Convert the archive to the tar archive TAR, '-' for standard output", metavar='TAR')
+    group.add_argument('--from-tar', help="Create the archive from the tar archive TAR, '-' for standard input", metavar='TAR')
+    group.add_argument('--merge', help='Merge archives into the archive ARCHIVE without extracting them', nargs='+', metavar='SOURCE')
+    group.add_argument('--split', help="Split the archive, or the files in DIR, into archives of at most MAX_ENTRIES entries, named PATTERN with '{}' replaced by the part number", metavar='PATTERN')
+    group.add_argument('--diff', help='Print the entries added, removed and changed from the archive OLD to the archive ARCHIVE as JSON, exiting with status 1 if they differ',
+                       metavar='OLD')
+    group.add_argument('-i', '--index', help='Index the archives in DIR into the catalog ARCHIVE', action='store_true', default=False)
+    group.add_argument('-s', '--search', help="Search the catalog ARCHIVE for archives containing file names, or hashes starting with '0x'", nargs='+', metavar='NAME')
     parser.add_argument('-e', '--endianess', help='Set archive endianess', choices=['big', 'little'], type=str, default='little')
-    parser.add_argument('-k', '--hashkey', help='Set hash key', default=DEFAULT_HASH_KEY)
+    parser.add_argument('-k', '--hashkey', help='Set hash key', type=lambda x: int(x, 0), default=DEFAULT_HASH_KEY)
     parser.add_argument('-d', '--dir', help='Set working directory')
-    parser.add_argument('-f', '--archive', help='Set archive file', required=True)
+    parser.add_argument('-f', '--archive', help='Set archive file')
+    parser.add_argument('-b', '--batch', help="Extract, list or create many archives in parallel, with JOBS processes. Set archives, or directories to create archives from, as paths, glob patterns, or '@' and a manifest file listing one per line",
+                        nargs='+', metavar='ARCHIVE')
     parser.add_argument('-n', '--exclude', help='Set exclude files', nargs='*', type=str)
+    parser.add_argument('-a', '--add', help='Set files in DIR to add or replace when updating, named relative to DIR, default all files in DIR', nargs='*', type=str)
+    parser.add_argument('--remove', help='Set entry names to remove when updating', nargs='*', type=str)
+    parser.add_argument('-m', '--names', help='Set hash to name mapping file')
+    parser.add_argument('-w', '--wordlist', help='Set wordlist files for name recovery', nargs='*', type=str)
+    parser.add_argument('-t', '--template', help="Set name templates for name recovery, e.g. 'timg/{}.bflim'", nargs='*', type=str)
+    parser.add_argument('-j', '--jobs', help='Set number of worker threads, or of worker processes with -b', type=int, default=1)
+    parser.add_argument('-z', '--yaz0', help='Compress the created archive with Yaz0 at LEVEL from 0 (fastest) to 9 (smallest), default %d. Enabled for .szs archives'%YAZ0_DEFAULT_LEVEL,
+                        metavar='LEVEL', nargs='?', type=int, choices=range(10), const=YAZ0_DEFAULT_LEVEL)
+    parser.add_argument('--cache', help='Reuse unchanged files from the previous build of the archive', action='store_true', default=False)
+    parser.add_argument('--dedup', help='Store files with identical contents once in the created archive', action='store_true', default=False)
+    parser.add_argument('--stats', help='Print the time spent in each phase of creating or extracting archives to standard error, as text or JSON',
+                        nargs='?', choices=['text', 'json'], const='text')
+    parser.add_argument('--max-entries', help='Set maximum number of entries per archive when splitting, default %d'%Sarc.FATBlockHeader._C_ARCHIVE_ENTRY_MAX,
+                        type=int, default=Sarc.FATBlockHeader._C_ARCHIVE_ENTRY_MAX)
+    parser.add_argument('--on-conflict', help='Fail on entries with the same hash or name and different contents when merging, or keep the first or last of them',
+                        choices=['error', 'first', 'last'], default='error')
+    parser.add_argument('--dry-run', help='Print the archive size without creating it', action='store_true', default=False)
     args = parser.parse_args()
+    if not args.archive and not (args.batch and (args.extract or args.list or args.create)) and not (args.split and args.dir):
+        parser.error('argument -f/--archive is required')
     
+    if args.batch:
+        mode = 'extract' if args.extract else 'list' if args.list else 'create'
+        failed = batch_archives(mode, args.batch, args.dir, args.jobs, args.verbose,
+                                order=endianess[args.endianess], hash_key=args.hashkey,
+                                exclude=args.exclude, cache=args.cache, yaz0_level=args.yaz0,
+                                dedup=args.dedup, names=args.names)
+        sys.exit(1 if failed else 0)
+    stats = Stats(per_entry=True) if args.stats else None
     if args.create:
-        create_archive(args.dir, args.archive, endianess[args.endianess], args.hashkey, args.verbose, args.exclude)
+        create_archive(args.dir, args.archive, endianess[args.endianess], args.hashkey, args.verbose, args.exclude, args.dry_run, args.jobs, args.cache,
+                       args.yaz0, args.dedup, stats)
     if args.extract:
-        extract_archive(args.dir, args.archive, args.verbose)
+        extract_archive(args.dir, args.archive, args.verbose, args.jobs, args.names, stats)
     if args.list:
-        list_archive(args.archive)
+        list_archive(args.archive, args.names)
+    if args.update:
+        update_archive(args.dir, args.archive, args.add, args.remove, args.verbose)
+    if args.recover:
+        recover_archive_names(args.archive, args.wordlist, args.template, args.names)
+    if args.to_tar:
+        archive_to_tar(args.archive, args.to_tar, args.verbose)
+    if args.from_tar:
+        tar_to_archive(args.from_tar, args.archive, endianess[args.endianess], args.hashkey, args.verbose, args.exclude,
+                       args.yaz0, args.dedup, stats)
+    if args.merge:
+        merge_archives(args.merge, args.archive, args.on_conflict, args.verbose, args.yaz0, args.dedup, stats)
+    if args.split:
+        split_archive(args.dir, args.archive, args.split, args.max_entries, endianess[args.endianess], args.hashkey,
+                      args.verbose, args.exclude, args.yaz0, stats)
+    if args.diff:
+        differs = diff_archives(args.diff, args.archive, args.jobs)
+    if args.index:
+        index_catalog(args.dir, args.archive, args.jobs, args.verbose)
+    if args.search:
+        search_catalog(args.archive, args.search)
+    if args.stats == 'json':
+        print >> sys.stderr, json.dumps(stats.to_dict(), sort_keys=True)
+    elif args.stats:
+        print >> sys.stderr, stats.report()
+    if args.diff:
+        sys.exit(2 if differs is None else 1 if differs else 0)
     